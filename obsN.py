@@ -1,17 +1,14 @@
 import sqlite3
 import datetime
-import pytz
+import re
 import os
 import sys
-import glob
-import frontmatter
 import logging
-import random
-import argparse
-import yaml
-import shutil
-from pathlib import Path
-from pprint import pprint
+import atexit
+import functools
+import time
+# Everything else (pytz, frontmatter, yaml, glob, shutil, ...) is imported in the functions
+# that use it - a quick log (-l) should not have to wait for modules it never uses.
 
 '''
     This is the config! 
@@ -37,16 +34,63 @@ cfg = {
     'db_file' : 'obsN.sqlite',
     'db_table' : 'obsNotes',
     'log_level' : '2', 
+    'db_cache_mb' : 32,
+    'db_mmap_mb' : 256,
+    'db_busy_timeout' : 5000,
+    'page_size' : 20,
+    'pager' : '',
+    'backup_compression' : 'gz',
+    'backup_pages' : 1024,
+    'export_workers' : 4,
+    'socket_file' : 'obsN.sock',
+    'serve_batch' : 500,
+    'serve_wait_ms' : 0,
+    'ingest_batch' : 10000,
+    'trace' : '',
+    'log_max_kb' : 1024,
+    'log_keep' : 5,
+    'watch_debounce_ms' : 500,
+    'watch_poll_s' : 1.0,
+    'timezone' : 'Europe/Stockholm',
+    'compress_notes' : '',
+    'compress_min_bytes' : 4096,
     }
 
 script_dir = os.path.dirname(__file__)
 
 
-if os.path.exists(f"{script_dir}/config.yaml"):
-    with open(f"{script_dir}/config.yaml") as f:
-        cfg = yaml.load(f, Loader=yaml.FullLoader)
+def load_cfg():
+    """Reads config.yaml into cfg (settings missing in the file keep their default).
+    Importing yaml takes longer than writing a quick log, so the parsed settings are cached as
+    JSON (.config.yaml.json) and config.yaml is only parsed again when its mtime or size changes."""
+    import json
+    cfg_path = f"{script_dir}/config.yaml"
+    cache_path = f"{script_dir}/.config.yaml.json"
+    stat = os.stat(cfg_path)
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache['mtime_ns'] == stat.st_mtime_ns and cache['size'] == stat.st_size:
+            cfg.update(cache['cfg'])
+            return
+    except (OSError, ValueError, KeyError):
+        pass
+    import yaml
+    with open(cfg_path) as f:
+        settings = yaml.load(f, Loader=yaml.FullLoader)
+    cfg.update(settings)
+    try:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'cfg': settings}, f)
+    except (OSError, TypeError):
+        pass  # no cache, config.yaml is parsed every time
+
+
+if __name__ == "__main__" and os.path.exists(f"{script_dir}/config.yaml"):
+    load_cfg()  # only for the CLI - importing obsN reads nothing, pass the settings to NotesStore
 
 def write_cfg():
+    import yaml
     if not os.path.exists(f"{script_dir}/config.yaml"):
         with open(f"{script_dir}/config.yaml", "w") as yamlfile:
             yaml.dump(cfg, yamlfile)
@@ -66,10 +110,10 @@ backup_folder = cfg['backup_folder']
 log_folder = cfg['log_folder']
 db_file = cfg['db_file']
 db_table = cfg['db_table']
-log_level = cfg['log_level']  # 1 = separate file for every run, save all, 2 just save the latest run
+log_level = cfg['log_level']  # 1 = separate file for every run, 2 = one rotated log.log, or a level name - see do_the_logging()
 
 if backup_folder == "~":
-    backup_folder = f"{str(Path.home())}"
+    backup_folder = os.path.expanduser("~")
 
 # Definitions - do not change these
 main_folder = os.path.join(script_dir, main_folder)
@@ -80,6 +124,11 @@ cache_folder = os.path.join(script_dir, main_folder, cache_folder)
 daily_folder = os.path.join(script_dir, main_folder, daily_folder)
 export_folder = os.path.join(script_dir, main_folder, export_folder)
 folder_list = [main_folder, tmp_folder, cache_folder, log_folder, daily_folder, export_folder]
+store = None  # the notes of this run, see get_store()
+socket_path = os.path.join(main_folder, cfg['socket_file'])  # where `serve()` listens
+bulk_rows = 1000  # write_many() of this many notes or more defers the insert triggers
+tracing = os.environ.get("OBSN_TRACE", cfg['trace'])  # '' = off, 'summary' or 'json', see traced()
+spans = {}  # name: [calls, seconds, rows, bytes] - filled by traced() and trace_add()
 
 """
 Adapters for sqlite datetime 
@@ -96,10 +145,6 @@ def adapt_datetime_iso(val):
     return val.isoformat()
 
 
-sqlite3.register_adapter(datetime.date, adapt_date_iso)
-sqlite3.register_adapter(datetime.datetime, adapt_datetime_iso)
-
-
 def convert_date(val):
     """Convert ISO 8601 date to datetime.date object."""
     return datetime.date.fromisoformat(val.decode())
@@ -115,28 +160,65 @@ def convert_timestamp(val):
     return datetime.datetime.fromtimestamp(int(val))
 
 
-sqlite3.register_converter("date", convert_date)
-sqlite3.register_converter("datetime", convert_datetime)
-sqlite3.register_converter("timestamp", convert_timestamp)
+def register_adapters():
+    """Registers the adapters and converters above with sqlite3 (done when a store connects, not on import)"""
+    sqlite3.register_adapter(datetime.date, adapt_date_iso)
+    sqlite3.register_adapter(datetime.datetime, adapt_datetime_iso)
+    sqlite3.register_converter("date", convert_date)
+    sqlite3.register_converter("datetime", convert_datetime)
+    sqlite3.register_converter("timestamp", convert_timestamp)
+
 
 
+@functools.lru_cache(maxsize=8)
+def get_tz(name=None):
+    """Gets the timezone `name` (default: `timezone` in the config, Europe/Stockholm)
+    - made on the first call and then reused"""
+    import pytz
+    return pytz.timezone(name or cfg['timezone'])
 
-def get_date():
-    """Gets the datetime date for Europe/Stockholm timezone"""
-    local_date = datetime.datetime.now(pytz.timezone('Europe/Stockholm')).date()
+
+def get_date(tz_name=None):
+    """Gets the datetime date for the timezone `tz_name` (default: the one in the config)"""
+    local_date = datetime.datetime.now(get_tz(tz_name)).date()
     local_date = datetime.datetime.strftime(local_date, '%Y-%m-%d')
     return local_date
 
 
-def get_time():
-    """Gets the datetime time for Europe/Stockholm timezone and formats it"""
-    now = datetime.datetime.now(pytz.timezone('Europe/Stockholm'))
+def get_time(tz_name=None):
+    """Gets the datetime time for the timezone `tz_name` (default: the one in the config) and formats it"""
+    now = datetime.datetime.now(get_tz(tz_name))
     local_time = now.strftime("%H:%M:%S")
     return local_time
 
 
+@functools.lru_cache(maxsize=1024)
+def hour_ts(date, hour, tz_name=None):
+    """UTC epoch seconds of the start of a local hour (date as 2024-01-31, hour as 12),
+    remembered - the notes of a bulk write mostly share a few hours"""
+    local = datetime.datetime.strptime(f"{date} {hour}", "%Y-%m-%d %H")
+    offset = get_tz(tz_name).localize(local).utcoffset()
+    return int(local.replace(tzinfo=datetime.timezone.utc).timestamp() - offset.total_seconds())
+
+
+def to_ts(date, the_time="00:00:00", tz_name=None):
+    """Turns a local date (2024-01-31) and time (12:00:00 or 12:00) into UTC epoch seconds
+    (the `created_ts` of a note), None if they can't be read"""
+    try:
+        return hour_ts(date, the_time[:2], tz_name) + int(the_time[3:5]) * 60 + int(the_time[6:8] or 0)
+    except (ValueError, TypeError):
+        return None
+
+
+def next_day(date):
+    """The date (2024-01-31) after `date`"""
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=1)).isoformat()
+
+
+@functools.lru_cache(maxsize=256)
 def only_alnu(fix_str):
-    """Removes all nonalpha-numerical characters from a string"""
+    """Removes all nonalpha-numerical characters from a string
+    (remembers the last ones, bulk writes clean the same book/chapter/part over and over)"""
     fixed_str = ''.join(e for e in fix_str if e.isalnum())
     return fixed_str
 
@@ -144,6 +226,7 @@ def only_alnu(fix_str):
 def gen_color():
     """Generates a random hex-value similar to a hex-color-code.
     Really only to have some random characters."""
+    import random
     color = random.randrange(0, 2 ** 24)
     hex_color = hex(color)
     hex_color = hex_color[2:]
@@ -151,13 +234,34 @@ def gen_color():
 
 
 def do_the_logging():
-    """Defines the logging-settings"""
-    log_file = "log.log"
-    if log_level == 1:
-        log_file = f"{get_date()}_{get_time().replace(':', '-')}_{gen_color()}.log"
-    log_file = os.path.join(log_folder, log_file)
-    format_str = "%(asctime)s:%(levelname)s:%(lineno)i:%(message)s"
-    logging.basicConfig(filename=log_file, encoding='utf-8', filemode='w', format=format_str, level=logging.DEBUG)
+    """Defines the logging-settings. `log()` only puts the records on a queue and a background
+    thread (QueueListener) writes them to the log folder, so a log line never waits for the disk.
+    `log_level` in the config:
+     * 1 gives every run a file of its own, the newest `log_keep` of them are kept
+     * 2 logs to log.log, which is rotated at `log_max_kb` (keeping `log_keep` old ones)
+     * debug, info, warning or error does the same as 2 but only from that level up"""
+    import logging.handlers
+    import queue
+    level = str(log_level).strip().lower()
+    if level == "1":
+        old_logs = sorted(name for name in os.listdir(log_folder) if name.endswith(".log") and name[:1].isdigit())
+        for name in old_logs[:max(len(old_logs) - int(cfg['log_keep']) + 1, 0)]:
+            os.remove(os.path.join(log_folder, name))
+        log_file = os.path.join(log_folder, f"{get_date()}_{get_time().replace(':', '-')}_{gen_color()}.log")
+        handler = logging.FileHandler(log_file, encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(os.path.join(log_folder, "log.log"), encoding='utf-8',
+                                                       maxBytes=int(cfg['log_max_kb']) * 1024,
+                                                       backupCount=int(cfg['log_keep']))
+    handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(lineno)i:%(message)s"))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    logger = logging.getLogger()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    levels = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+    logger.setLevel(levels.get(level, logging.DEBUG))
+    listener.start()
+    atexit.register(listener.stop)
     logging.info('asctime:levelname:lineno:message')
 
 
@@ -165,34 +269,218 @@ def log(sel, mess):
     """A shorter syntax for logging"""
     match sel:
         case 1:
-            logging.error(mess)
+            logging.error(mess, stacklevel=2)
         case 2:
-            logging.debug(mess)
+            logging.debug(mess, stacklevel=2)
         case 3:
-            logging.info(mess)
-
-def make_backup():
-    sql_q = f"SELECT * FROM '{db_table}'"
-    now_date = get_date()
-    export_things_md(sql_q)
-    archive_path = f"{backup_folder}/obsNotes_backup_{str(now_date)}"
-    shutil.make_archive(archive_path, 'tar', export_folder)
-    for filename in os.listdir(export_folder):
-        file_path = os.path.join(export_folder, filename)
+            logging.info(mess, stacklevel=2)
+
+
+def traced(function):
+    """Decorator that times every call of `function` as a span (calls, seconds, rows, bytes).
+    With tracing off (`trace` in config.yaml or $OBSN_TRACE empty) the function is returned
+    as it is, so it costs nothing. A returned str/bytes counts as bytes, a generator
+    (like `print_nice()`) counts its items as rows and is timed until it is used up."""
+    if not tracing:
+        return function
+    import inspect
+    name = getattr(function, "__qualname__", repr(function))
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            rows = nbytes = 0
+            try:
+                for item in function(*args, **kwargs):
+                    rows += 1
+                    nbytes += len(item) if isinstance(item, (str, bytes)) else 0
+                    yield item
+            finally:
+                trace_add(name, rows, nbytes, time.perf_counter() - start)
+        return wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = None
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
-    return f"{archive_path}.tar"
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            nbytes = len(result) if isinstance(result, (str, bytes)) else 0
+            trace_add(name, 0, nbytes, time.perf_counter() - start)
+    return wrapper
+
+
+def trace_add(name, rows=0, nbytes=0, seconds=0.0, calls=1):
+    """Adds to the span `name`. For counters a call does not return, use it under `if tracing:`"""
+    span = spans.get(name)
+    if span is None:
+        span = spans[name] = [0, 0.0, 0, 0]
+    span[0] += calls
+    span[1] += seconds
+    span[2] += rows
+    span[3] += nbytes
+
+
+def dump_spans():
+    """At exit: prints the spans as a table on stderr (trace: summary)
+    or writes them to trace.json in the log folder (trace: json)."""
+    if not spans:
+        return
+    if tracing == "json":
+        import json
+        os.makedirs(log_folder, exist_ok=True)
+        with open(os.path.join(log_folder, "trace.json"), "w", encoding="utf-8") as f:
+            json.dump({name: {'calls': span[0], 'seconds': round(span[1], 6), 'rows': span[2], 'bytes': span[3]}
+                       for name, span in spans.items()}, f, indent=1)
+        return
+    sys.stderr.write(f"{'span':<32} {'calls':>8} {'total ms':>10} {'avg ms':>9} {'rows':>9} {'bytes':>11}\n")
+    for name, (calls, seconds, rows, nbytes) in sorted(spans.items(), key=lambda item: -item[1][1]):
+        sys.stderr.write(f"{name:<32} {calls:>8} {seconds * 1000:>10.2f} {seconds * 1000 / calls:>9.3f} "
+                         f"{rows:>9} {nbytes:>11}\n")
+
+
+if tracing:
+    atexit.register(dump_spans)
+
+
+@traced
+def replay_backups(target):
+    """Rebuilds the markdown files of the latest backup in the folder `target` (see `NotesStore.replay()`)"""
+    archives = get_store().replay(target)
+    if archives is None:
+        print("No backup manifest found!")
+        return False
+    for archive in archives:
+        print(f" Replayed {archive}")
+    return target
+
+
+def tar_add(tar, path, data, mtime):
+    """Adds `data` (bytes) to an open tarfile as the file `path`, straight from memory"""
+    import io
+    import tarfile
+    info = tarfile.TarInfo(path)
+    info.size = len(data)
+    info.mtime = int(mtime)  # a float mtime costs every file an extra (pax) header
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+@traced
+def make_backup(incremental=False, compression=None):
+    """Archives the DB as markdown files in a single tar in the backup folder (see `NotesStore.backup()`)"""
+    archive_path, archived, removed = get_store().backup(incremental, compression)
+    print(f" Archived {archived} notes ({removed} removed).")
+    return archive_path
 
 
+@traced
+def backup_db(compact=False):
+    """Makes a snapshot of the database file in the backup folder (see `NotesStore.backup_db()`)"""
 
+    def progress(status, remaining, total):
+        print(f"\r Copied {total - remaining}/{total} pages", end="", flush=True)
+
+    try:
+        snapshot_path = get_store().backup_db(compact, progress)
+    except sqlite3.Error as error:
+        print("\nCould not make the DB snapshot!")
+        log(1, f"backup_db() had an except (sqlite3.error): {error}")
+        return False
+    print()
+    if compact:
+        print(" Compacted the snapshot (VACUUM INTO)")
+    return snapshot_path
+
+
+@traced
+def restore_notes(source, workers=None):
+    """Loads the notes of a backup tar or a folder of exported notes into the DB, keeping their iD's
+    (see `NotesStore.restore()`) and prints how it went"""
+
+    def progress(restored, skipped):
+        print(f"\r Restored {restored} notes ({skipped} skipped)", end="", flush=True)
+
+    if not os.path.exists(source):
+        print(f"Can't find {source}!")
+        return False
+    start = time.perf_counter()
+    try:
+        restored, skipped, failed = get_store().restore(source, workers, progress)
+    except (OSError, sqlite3.Error) as error:
+        print(f"\nRestoring from {source} failed! The notes restored so far are kept, run it again to go on.")
+        log(1, f"restore_notes() had an error: {error}")
+        return False
+    seconds = time.perf_counter() - start
+    print(f"\r Restored {restored} notes in {seconds:.2f}s ({restored / max(seconds, 0.001):.0f} notes/s), "
+          f"{skipped} skipped (their iD was already taken)")
+    for name in failed:
+        print(f" Could not read {name}")
+    return restored
+
+
+@traced
+def compress_notes(method=None, vacuum=False):
+    """Compresses the large notes already in the DB (see `NotesStore.compress()`) and prints how much smaller
+    they got, with `vacuum` the DB file is compacted afterwards so the space is given back."""
+    store = get_store()
+    start = time.perf_counter()
+    try:
+        store.connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(store.db_file)
+        changed, before, after = store.compress(method)
+        if vacuum:
+            store.connect().execute("VACUUM")
+            store.connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sqlite3.Error as error:
+        print("Compressing the notes failed!")
+        log(1, f"compress_notes() had an except (sqlite3.error): {error}")
+        return False
+    mb = 1024 * 1024
+    print(f" Changed {changed} notes in {time.perf_counter() - start:.2f}s: "
+          f"{before / mb:.2f} MB -> {after / mb:.2f} MB (saved {(before - after) / mb:.2f} MB)")
+    if vacuum:
+        print(f" DB file: {size / mb:.2f} MB -> {os.path.getsize(store.db_file) / mb:.2f} MB")
+    else:
+        print(" The DB file gets smaller with '--compress-notes --vacuum'.")
+    return changed
+
+
+def pack_note(note, method, min_bytes):
+    """Compresses a note of `min_bytes` (UTF-8) or more with `method` (zlib or lzma) into bytes
+    (stored as a BLOB): one byte for the method (z or x) and then the compressed text.
+    The note is returned as it is if it is shorter, `method` is empty or it doesn't get smaller."""
+    if not method or not isinstance(note, str) or len(note) * 4 < min_bytes:
+        return note
+    data = note.encode("utf-8")
+    if len(data) < min_bytes:
+        return note
+    if method == "lzma":
+        import lzma
+        packed = b"x" + lzma.compress(data)
+    else:
+        import zlib
+        packed = b"z" + zlib.compress(data, 6)
+    return packed if len(packed) < len(data) else note
+
+
+def note_text(note):
+    """The text of a note from the DB - unpacks a compressed one (see `pack_note()`).
+    Also the SQL function note_text() (see `NotesStore.connect()`)"""
+    if not isinstance(note, bytes):
+        return note
+    if note[:1] == b"x":
+        import lzma
+        return lzma.decompress(note[1:]).decode("utf-8")
+    import zlib
+    return zlib.decompress(note[1:]).decode("utf-8")
+
+
+@traced
 def gen_write_data(row):
     """Takes a database row and generates a string to print out"""
-    log(2, "gen_write_data()")
     tags = prt_tags(row[6])
     write_data = (f"""---
 iD: {row[0]} 
@@ -202,14 +490,14 @@ Part: {row[3]}
 Created: {row[4]} {row[5]}
 Tags: 
 {tags}---
-{row[7]} 
+{note_text(row[7])} 
     """)
     return write_data
 
 
+@traced
 def prt_tags(row):
     """Takes the database `tags` field and generates a yaml-frontmatter version"""
-    log(2, "prt_tags()")
     tags = "- \n"
     if row is None:
         return tags
@@ -222,36 +510,35 @@ def prt_tags(row):
     return tags
 
 
+def split_tags(tags):
+    """Takes the database `tags` field ("a;b;c;") and returns the tags as a list"""
+    if tags is None:
+        return []
+    return [tag.strip(" #") for tag in tags.split(";") if tag.strip(" #")]
+
+
+@traced
+def write_tags(cur, the_id, tags):
+    """Writes the tags of a note to the `note_tags` table (replacing the ones it had).
+    Runs on the cursor of the caller so it is part of the same transaction."""
+    cur.execute("DELETE FROM note_tags WHERE note_id = ?", (the_id,))
+    cur.executemany("INSERT OR IGNORE INTO note_tags (note_id, tag) VALUES (?,?)",
+                    [(the_id, tag) for tag in split_tags(tags)])
+
+
+@traced
 def write_any(book, chapter, part, date, time, tags, note):
     """Writes any note to the DB, all given"""
-    log(2, "write_any()")
-    book = only_alnu(book)
-    chapter = only_alnu(chapter)
-    part = only_alnu(part)
     try:
-        conn = sqlite3.connect(db_file)
-        log(2, " - Connected to db")
-        cur = conn.cursor()
-        sql_q = f"""
-            INSERT INTO {db_table} (book, chapter, part, date, time, tags, note) 
-            VALUES (?,?,?,?,?,?,?);
-            """
-        insert_tuple = (book, chapter, part, date, time, tags, note)
-        cur.execute(sql_q, insert_tuple)
-        log(2, " - tuple inserted")
-        conn.commit()
-        conn.close()
-        log(2, " - Connection closed")
+        return get_store().write(book, chapter, part, date, time, tags, note)
     except sqlite3.Error as error:
         log(1, f"write_any() had an except (sqlite3.error): {error}")
 
 
-def write_any_log(book, chapter, part, line):
-    """Writes a log to any book/chapter"""
-    log(2, "write_any_log()")
-    book = only_alnu(book)
-    chapter = only_alnu(chapter)
-    part = only_alnu(part)
+def log_to_note(book, chapter, part, line, date=None, the_time=None, tz_name=None):
+    """Turns a log line into a note (written now in `tz_name` if no date/time is given) - the arguments
+    of `write_any()` as a tuple.
+    Words starting with # are taken out of the line and become the tags."""
     words = line.split()
     tags = ""
     for word in words:
@@ -259,25 +546,53 @@ def write_any_log(book, chapter, part, line):
             line = line.replace(word, '')
             word = word.replace('#', '')
             tags += f"{word};"
-    now_date = get_date()
-    now_time = get_time()
-    write_any(book, chapter, part, now_date, now_time, tags, line)
+    return (only_alnu(book), only_alnu(chapter), only_alnu(part), date or get_date(tz_name),
+            the_time or get_time(tz_name), tags, line)
+
+
+@traced
+def write_any_log(book, chapter, part, line):
+    """Writes a log to any book/chapter"""
+    write_any(*log_to_note(book, chapter, part, line))
 
 
+@traced
 def write_log(line):
     """Writes a line to the journal/log"""
-    log(2, "write_log()")
     if len(line) > 2:
         write_any_log("notes", "journal", "log", line)
     else:
         log(2, " - line shorter than 2 char, return false!")
         return False
 
-  
-def write_file(file):
-    """Writes the given long-file to DB"""
-    log(2, "write_file()")
-    post = frontmatter.load(file)
+
+stamp_re = re.compile(r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}(?::\d{2})?)\S*\s+|(\d{9,10})(?:\.\d+)?\s+")
+
+
+def split_stamp(line, tz_name=None):
+    """Takes a timestamp off the start of a line: `2024-01-31 12:00[:00]` (or with a T, trailing
+    fractions/offset are ignored) or unix seconds (as in `history` and most logs, turned into the local
+    time of `tz_name`, default: the timezone in the config).
+    Returns (date, time, rest of the line), date and time are None if the line has no timestamp."""
+    match = stamp_re.match(line)
+    if match is None:
+        return None, None, line
+    if match.group(3):
+        stamp = datetime.datetime.fromtimestamp(int(match.group(3)), get_tz(tz_name))
+        return stamp.strftime('%Y-%m-%d'), stamp.strftime('%H:%M:%S'), line[match.end():]
+    the_time = match.group(2) if len(match.group(2)) == 8 else f"{match.group(2)}:00"
+    return match.group(1), the_time, line[match.end():]
+
+
+@traced
+def write_log_stream(lines, stamped=False, book="notes", chapter="journal", part="log"):
+    """Writes every line of an iterable (a file, stdin) as a log (see `NotesStore.write_log_stream()`)"""
+    return get_store().write_log_stream(lines, stamped, book, chapter, part)
+
+
+def post_to_note(post):
+    """Takes a loaded long-file (frontmatter post) and returns the note as
+    (book, chapter, part, date, time, tags, note) - the arguments of `write_any()`"""
     metadata = post.metadata          
     content = post.content
     book = metadata.get('Book')
@@ -291,15 +606,130 @@ def write_file(file):
     for tag in tagses:
         if tag is not None and len(tag) > 2:
             tags += f"{tag};"
+    return (book, chapter, part, date, the_time, tags, content)
+
+
+export_re = re.compile(r"---\niD: (\d+) \nBook: ([^\n]*)\nChapter: ([^\n]*)\nPart: ([^\n]*)\n"
+                       r"Created: (\S+) (\S+)\nTags: \n((?:- [^\n]*\n)*)---\n(.*) \n    ", re.S)
+
+
+def parse_export(files):
+    """Parses exported notes: `files` is a list of (name, bytes). The files as `gen_write_data()` writes them
+    are read with `export_re` (the note comes back exactly, no YAML needed), other ones with frontmatter.
+    Returns (notes, failed) - the notes as (iD, book, chapter, part, date, time, tags, note), iD None
+    if the file has none, and the names of the files that could not be read (or have no Book, Chapter or Created).
+    Runs in the worker processes of `NotesStore.restore()`."""
+    notes = []
+    failed = []
+    for name, data in files:
+        try:
+            text = data.decode("utf-8")
+            match = export_re.fullmatch(text)
+            if match:
+                the_id, book, chapter, part, date, the_time, tags, note = match.groups()
+                tags = "".join(f"{tag[2:]};" for tag in tags.splitlines() if len(tag) > 3)
+                notes.append((int(the_id), book, chapter, part, date, the_time, tags, note))
+                continue
+            import frontmatter
+            post = frontmatter.loads(text)
+            metadata = post.metadata
+            if any(metadata.get(key) is None for key in ('Book', 'Chapter', 'Created')):
+                raise ValueError("no Book, Chapter or Created")  # not an exported note
+            created = metadata.get('Created')
+            if isinstance(created, datetime.datetime):
+                date, the_time = created.strftime('%Y-%m-%d'), created.strftime('%H:%M:%S')
+            else:
+                date, the_time = (str(created).split() + ["00:00:00"])[:2]
+            tags = "".join(f"{tag};" for tag in metadata.get('Tags') or [] if tag is not None and len(str(tag)) > 1)
+            the_id = metadata.get('iD')
+            part = metadata.get('Part')
+            notes.append((int(the_id) if the_id is not None else None, str(metadata['Book']), str(metadata['Chapter']),
+                          str(part) if part is not None else "", date, the_time, tags, post.content))
+        except Exception:  # anything from a broken file or bad YAML
+            failed.append(name)
+    return notes, failed
+
+
+def export_entries(source):
+    """Yields (name, bytes) of every .md file in a backup tar (any compression, read as a stream, see
+    `NotesStore.backup()`) or a folder of exported notes (see `NotesStore.export()`)"""
+    if os.path.isdir(source):
+        for folder, folders, names in os.walk(source):
+            folders.sort()
+            for name in sorted(names):
+                if name.endswith(".md"):
+                    path = os.path.join(folder, name)
+                    with open(path, "rb") as f:
+                        yield path, f.read()
+        return
+    import tarfile
+    with tarfile.open(source, "r:*") as tar:
+        for info in tar:
+            if info.isfile() and info.name.endswith(".md"):
+                yield info.name, tar.extractfile(info).read()
+            tar.members = []  # read once, front to back - don't keep every header
+
+
+@traced
+def write_file(file):
+    """Writes the given long-file to DB"""
+    import frontmatter
+    book, chapter, part, date, the_time, tags, content = post_to_note(frontmatter.load(file))
     write_any(book, chapter, part, date, the_time, tags, content)
     os.remove(file)
     log(2, " - Note written and file removed")
     print(f"Note written to {book}/{chapter}/{part}!")   
 
 
+@traced
+def write_many(notes):
+    """Writes a list of notes (the arguments of `write_any()` as tuples) to the DB in one transaction
+    (see `NotesStore.write_many()`) and returns their iD's. All or nothing - raises sqlite3.Error on failure."""
+    return get_store().write_many(notes)
+
+
+@traced
+def write_files(files, posts=None):
+    """Writes long-files to the DB in one transaction and removes them once it is committed.
+    If a file can't be read or the write fails nothing is written and every file is kept.
+    `posts` can hold already loaded files (frontmatter posts, in the same order) to skip reading them again."""
+    if not files:
+        return 0
+    import frontmatter
+    import yaml
+    start = time.perf_counter()
+    notes = []
+    for i, file in enumerate(files):
+        try:
+            post = posts[i] if posts else frontmatter.load(file)
+            notes.append(post_to_note(post))
+        except (OSError, ValueError, TypeError, AttributeError, yaml.YAMLError) as error:
+            print(f"Could not read {file} - nothing written!")
+            log(1, f"write_files() could not read {file}: {error}")
+            return 0
+    try:
+        write_many(notes)
+    except sqlite3.Error as error:
+        print("Writing the files failed - nothing written!")
+        log(1, f"write_files() had an except (sqlite3.error): {error}")
+        return 0
+    for file in files:
+        try:
+            os.remove(file)
+        except OSError as error:
+            print(f"Written but could not remove {file}!")
+            log(1, f"write_files() could not remove {file}: {error}")
+    if tracing:
+        trace_add("write_files", len(notes), calls=0)
+    seconds = time.perf_counter() - start
+    print(f"Wrote {len(notes)} notes in {seconds:.2f}s ({len(notes) / max(seconds, 0.001):.0f} notes/s)")
+    return len(notes)
+
+
+@traced
 def update_from_file(path):
     """Writes changes from a file to the database"""
-    log(2, "update_from_file()")
+    import frontmatter
     post = frontmatter.load(path)
     metadata = post.metadata          
     content = post.content
@@ -316,23 +746,8 @@ def update_from_file(path):
     date = datetime.datetime.strftime(created, '%Y-%m-%d')
     the_time = datetime.datetime.strftime(created, '%H:%M:%S')
     try:
-        conn = sqlite3.connect(db_file)
-        log(2, " - Connected to db")
-        cur = conn.cursor()
-        sql_q = (f"""UPDATE {db_table} 
-        SET book = '{book}', 
-        chapter ='{chapter}', 
-        part = '{part}', 
-        date = '{date}', 
-        time = '{the_time}', 
-        tags = '{tags}', 
-        note = '{content}' 
-        WHERE iD = '{the_id}'""")
-        cur.execute(sql_q)
-        conn.commit()
+        get_store().update(the_id, book, chapter, part, date, the_time, tags, content)
         log(2, " - db updated")
-        conn.close()
-        log(2, " - connection closed")
     except sqlite3.Error as error:
         log(1, f"update_from_file() had an except (sqlite3.error): {error}")
     finally:
@@ -342,16 +757,16 @@ def update_from_file(path):
 
 
 def write_all_tmp_files():
-    """Finds ALL files in the tmp dir and writes them to db"""
-    files = glob.glob(f"{tmp_folder}*.md")
-    for file in files:
-        write_file(file)
+    """Finds ALL files in the tmp dir and writes them to db (in one go, see `write_files()`,
+    the ones `watch()` already put in the DB with `write_synced()`)"""
+    index = file_index(f"{tmp_folder}*.md", "tmp")
+    write_files(write_synced(list(index), index))
     return True
 
 
+@traced
 def create_file(book, chapter, part, date, path):
     """Creates a file to insert longer notes to the database"""
-    log(2, "create_file()")
     if os.path.exists(path.strip()):
         log(2, " - File already exists")
         print("File found!")
@@ -368,48 +783,1573 @@ def create_file(book, chapter, part, date, path):
         return path
 
 
-def get_things(sql_q):
+def read_message(line):
+    """Turns one line sent to the server into a note (a tuple for `write_many()`), None if it is too short.
+    A plain line is a log line for notes/journal/log, a JSON object can pick where it goes:
+    {"book": .., "chapter": .., "part": .., "line": ..} or a whole note with "note", "tags", "date" and "time".
+    Raises ValueError for a message that is not like that."""
+    if line.startswith("{"):
+        import json
+        message = json.loads(line)
+        if not isinstance(message, dict):
+            raise ValueError("a JSON message must be an object")
+        for key in ("book", "chapter", "part", "line", "note", "tags", "date", "time"):
+            value = message.get(key, "")
+            if not isinstance(value, str) and (value is not None or key in ("book", "chapter", "part", "line")):
+                raise ValueError(f'"{key}" must be a string')
+        try:  # read like `to_ts()` reads them, so the note gets its created_ts
+            date = message.get("date") and datetime.date.fromisoformat(message["date"]).isoformat()
+            the_time = message.get("time") and datetime.datetime.strptime(message["time"], "%H:%M:%S").strftime("%H:%M:%S")
+        except ValueError as error:
+            raise ValueError(f'"date" must be like 2024-01-31 and "time" like 12:00:00 ({error})') from None
+        book = message.get("book", "notes")
+        chapter = message.get("chapter", "journal")
+        part = message.get("part", "log")
+        if "note" not in message:
+            line = message.get("line", "")
+            return log_to_note(book, chapter, part, line) if len(line) > 2 else None
+        return (only_alnu(book), only_alnu(chapter), only_alnu(part), date or get_date(),
+                the_time or get_time(), message.get("tags", ""), message["note"])
+    return log_to_note("notes", "journal", "log", line) if len(line) > 2 else None
+
+
+@traced
+def serve():
+    """Runs the capture server: listens on `socket_path` and writes what it gets until it is stopped.
+    Every client connection sends lines (see `read_message()`) and closes its end, the server answers
+    "ok <number of notes written>" (or "error <why>") once they are committed.
+    The writer takes every note that is waiting (and waits `serve_wait_ms` for more) and commits up to
+    `serve_batch` notes at a time with `write_many()`, so clients that arrive together share one transaction."""
+    import socketserver
+    import threading
+    import queue
+    import signal
+    if send_to_server([]) is not None:
+        print(f"The server is already running ({socket_path})!")
+        return False
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # left behind by a server that did not stop cleanly
+    jobs = queue.Queue()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            notes = []
+            try:
+                for raw in self.rfile:
+                    note = read_message(raw.decode("utf-8").strip())
+                    if note is not None:
+                        notes.append(note)
+            except ValueError as error:
+                self.wfile.write(f"error {error}\n".encode("utf-8"))
+                return
+            job = {"notes": notes, "done": threading.Event(), "answer": f"ok {len(notes)}"}
+            if notes:
+                jobs.put(job)
+                job["done"].wait()
+            self.wfile.write(f"{job['answer']}\n".encode("utf-8"))
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)  # one is enough, let it finish the last batch
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Serving on {socket_path} (Ctrl+C to stop)")
+    log(3, f" - serving on {socket_path}")
+    wait = cfg['serve_wait_ms'] / 1000
+    try:
+        while True:
+            try:
+                batch = [jobs.get(timeout=1)]
+            except queue.Empty:
+                continue
+            count = len(batch[0]["notes"])
+            deadline = time.monotonic() + wait
+            while count < cfg['serve_batch']:
+                try:
+                    batch.append(jobs.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+                count += len(batch[-1]["notes"])
+            try:
+                write_many([note for job in batch for note in job["notes"]])
+            except Exception as error:  # one bad batch must not stop the server
+                log(1, f"serve() could not write {count} notes: {error!r}")
+                for job in batch:
+                    job["answer"] = f"error {error}"
+            for job in batch:
+                job["done"].set()
+            log(2, f" - {len(batch)} clients, {count} notes in one commit")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(socket_path)  # new clients write by themselves from here on
+        server.shutdown()
+        server.server_close()
+        print("Server stopped")
+        log(3, " - server stopped")
+    return True
+
+
+def send_to_server(lines, timeout=10):
+    """Sends lines to a running server (see `serve()`) and returns the number of notes it wrote.
+    Returns None if no server is running, so the caller can write them itself,
+    and False if the server answered with an error or not in time (better a note twice than lost)."""
+    import socket
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall("".join(f"{line}\n" for line in lines).encode("utf-8"))
+            sock.shutdown(socket.SHUT_WR)
+            answer = sock.makefile(encoding="utf-8").readline().split(" ", 1)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return None
+    except TimeoutError:
+        answer = ["timeout"]
+    if answer[0] != "ok":
+        log(1, f"send_to_server() got an error from the server: {answer}")
+        return False
+    return int(answer[1])
+
+
+def inotify_changes(folders, debounce):
+    """Yields the set of files in `folders` that were saved (written and closed, or moved in),
+    once nothing has been saved for `debounce` seconds - so an editor saving in several steps
+    gives one change. Uses inotify through ctypes (Linux only), raises OSError (or AttributeError
+    without inotify in the C library) right away if it can't watch them."""
+    import ctypes
+    import ctypes.util
+    import select
+    import struct
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    watches = {}
+    for folder in folders:
+        wd = libc.inotify_add_watch(fd, os.fsencode(folder), 0x08 | 0x80)  # IN_CLOSE_WRITE | IN_MOVED_TO
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+        watches[wd] = folder
+
+    def events():
+        try:
+            changed = set()
+            while True:
+                ready = select.select([fd], [], [], debounce if changed else None)[0]
+                if not ready:
+                    yield changed
+                    changed = set()
+                    continue
+                data = os.read(fd, 65536)
+                pos = 0
+                while pos < len(data):
+                    wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+                    name = data[pos + 16:pos + 16 + length].rstrip(b"\0")
+                    pos += 16 + length
+                    if name and wd in watches:
+                        changed.add(os.path.join(watches[wd], os.fsdecode(name)))
+        finally:
+            os.close(fd)
+
+    return events()
+
+
+def poll_changes(folders, debounce, interval):
+    """Like `inotify_changes()` but looks at the mtime and size of the files every `interval` seconds"""
+    def snapshot():
+        files = {}
+        for folder in folders:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    seen = snapshot()
+    changed = set()
+    last_change = 0
+    while True:
+        time.sleep(interval)
+        files = snapshot()
+        new = {path for path, stat in files.items() if seen.get(path) != stat}
+        seen = files
+        if new:
+            changed |= new
+            last_change = time.monotonic()
+        elif changed and time.monotonic() - last_change >= debounce:
+            yield changed
+            changed = set()
+
+
+@traced
+def watch():
+    """Keeps the DB up to date with the tmp and daily files while it runs: every file that is saved
+    is upserted with `sync_file()` (only that file is read) - once the editor has been quiet for
+    `watch_debounce_ms`. Files changed while it wasn't running are synced at the start.
+    Uses inotify, elsewhere it checks the folders every `watch_poll_s` seconds. Stop it with Ctrl-C."""
+    import fnmatch
+    patterns = {'tmp': f"{tmp_folder}*.md", 'daily': os.path.join(daily_folder, "*.md")}
+    folders = sorted({os.path.dirname(pattern) for pattern in patterns.values()})
+    debounce = cfg['watch_debounce_ms'] / 1000
+
+    def sync(files, name):
+        files = sorted(file for file in files if fnmatch.fnmatch(file, patterns[name]) and os.path.exists(file))
+        if not files:
+            return
+        index = load_index(name)
+        for file in files:
+            try:
+                old_id = index.get(file, {}).get('id')
+                the_id = sync_file(file, index)
+                if the_id is not None and index[file].get('synced') == index[file]['mtime']:
+                    print(f"{'Updated' if old_id == the_id else 'Wrote'} note {the_id} from {file}")
+            except (OSError, sqlite3.Error) as error:
+                print(f"Could not sync {file}!")
+                log(1, f"watch() could not sync {file}: {error}")
+        save_index(name, index)
+
+    try:
+        changes = inotify_changes(folders, debounce)
+        print(f"Watching {', '.join(folders)} (inotify), Ctrl-C to stop")
+    except (OSError, AttributeError) as error:
+        log(2, f" - no inotify ({error}), polling")
+        changes = poll_changes(folders, debounce, float(cfg['watch_poll_s']))
+        print(f"Watching {', '.join(folders)} (every {cfg['watch_poll_s']}s), Ctrl-C to stop")
+    for name, pattern in patterns.items():
+        index = file_index(pattern, name)
+        sync([file for file, entry in index.items() if entry.get('synced') != entry['mtime']], name)
+    try:
+        for changed in changes:
+            for name in patterns:
+                sync(changed, name)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+
+class NotesStore:
+    """The notes database as an object, for using obsN from other Python code:
+
+        store = obsN.NotesStore({'main_folder': '/home/me/notes'})
+        store.write_log("Tried the new API #python")
+        rows, first, last = store.search("api")
+
+    `config` holds the settings that differ from `cfg`, relative folders are in `base_dir`
+    (default: the folder of obsN.py). Nothing is read or opened before it is needed, then the store
+    keeps one connection (see `connect()`) until `close()` or the end of a `with` block.
+    The methods raise sqlite3.Error - the functions of the CLI around them log it instead."""
+
+    def __init__(self, config=None, base_dir=None):
+        self.cfg = dict(cfg, **(config or {}))
+        main = os.path.join(base_dir or script_dir, self.cfg['main_folder'])
+        self.db_file = os.path.join(main, self.cfg['db_file'])
+        self.db_table = self.cfg['db_table']
+        self.export_folder = os.path.join(main, self.cfg['export_folder'])
+        self.backup_folder = os.path.expanduser(self.cfg['backup_folder'])
+        self.conn = None
+        self.bulk = None  # the lock of a bulk load this store is doing (see `defer_bulk()`)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        """Gets the connection to the database.
+        It is opened (and tuned) on first use and then kept open until `close()`,
+        WAL lets readers and a writer work at the same time and with `synchronous=NORMAL`
+        a commit does not wait for the disk (a crash can lose the last commits, never corrupt the db).
+        A DB made by an older version is brought up to date (see `migrate()`) on the first connect."""
+        if self.conn is None:
+            log(2, "NotesStore.connect()")
+            register_adapters()
+            conn = sqlite3.connect(self.db_file, timeout=self.cfg['db_busy_timeout'] / 1000)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA cache_size = -{int(self.cfg['db_cache_mb']) * 1024}")
+            conn.execute(f"PRAGMA mmap_size = {int(self.cfg['db_mmap_mb']) * 1024 * 1024}")
+            conn.execute(f"PRAGMA busy_timeout = {int(self.cfg['db_busy_timeout'])}")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            tz_name = self.cfg['timezone']
+            conn.create_function("utc_ts", 2, lambda date, the_time: to_ts(date, the_time, tz_name), deterministic=True)
+            conn.create_function("note_text", 1, note_text, deterministic=True)
+            self.conn = conn
+            atexit.register(self.close)
+            log(2, " - Connected to db")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                            (self.db_table,)).fetchone():
+                try:
+                    self.migrate()  # a new DB is migrated by `create()`
+                except sqlite3.Error:
+                    self.close()  # so the next call tries again instead of using an old schema
+                    raise
+        return self.conn
+
+    def close(self):
+        """Closes the connection to the database (runs at exit too)"""
+        if self.conn is not None:
+            self.conn.execute("PRAGMA optimize")
+            self.conn.close()
+            self.conn = None
+            atexit.unregister(self.close)
+            log(2, "NotesStore.close() - Connection closed")
+
+    @traced
+    def create(self):
+        """Creates the notes table and brings it up to date with the migrations"""
+        sql_q = (f'CREATE TABLE "{self.db_table}" (\n'
+                 '	"iD"	INTEGER NOT NULL UNIQUE,\n'
+                 '	"book"	TEXT NOT NULL,\n'
+                 '	"chapter"	TEXT NOT NULL,\n'
+                 '	"part"	TEXT,\n'
+                 '	"date"	TEXT NOT NULL,\n'
+                 '	"time"	TEXT NOT NULL,\n'
+                 '	"tags"	TEXT,\n'
+                 '	"note"	TEXT,\n'
+                 '	PRIMARY KEY("iD" AUTOINCREMENT)\n'
+                 '    )')
+        conn = self.connect()
+        conn.execute(sql_q)
+        conn.commit()
+        self.migrate()
+
+    def migrations(self):
+        """The changes made to the database after the first version, oldest first.
+        The number of a migration is its place in the list (starting at 1),
+        `migrate()` runs the ones a database has not seen yet."""
+        db_table = self.db_table
+        fts_table = f"{db_table}_fts"
+        tree_add = """INSERT INTO "note_tree" (book, chapter, part, note_count, last_date)
+                VALUES ({row}.book, {row}.chapter, ifnull({row}.part, ''), 1, {row}.date)
+                ON CONFLICT (book, chapter, part) DO UPDATE
+                SET note_count = note_count + 1, last_date = max(ifnull(last_date, ''), excluded.last_date);"""
+        tree_remove = f"""UPDATE "note_tree" SET note_count = note_count - 1,
+                last_date = (SELECT max(date) FROM "{db_table}"
+                    WHERE book = {{row}}.book AND chapter = {{row}}.chapter AND ifnull(part, '') = ifnull({{row}}.part, ''))
+                WHERE book = {{row}}.book AND chapter = {{row}}.chapter AND part = ifnull({{row}}.part, '');
+                DELETE FROM "note_tree" WHERE book = {{row}}.book AND chapter = {{row}}.chapter
+                    AND part = ifnull({{row}}.part, '') AND note_count < 1;"""
+        migrations = [
+            # 1: FTS5 full-text index over tags and note, kept in sync by triggers.
+            # Ends with a rebuild that backfills the index for existing databases.
+            f"""
+            CREATE VIRTUAL TABLE "{fts_table}" USING fts5(
+                tags, note,
+                content='{db_table}', content_rowid='iD',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+            CREATE TRIGGER "{db_table}_fts_ai" AFTER INSERT ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"(rowid, tags, note)
+                VALUES (new.iD, new.tags, new.note);
+            END;
+            CREATE TRIGGER "{db_table}_fts_ad" AFTER DELETE ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"("{fts_table}", rowid, tags, note)
+                VALUES ('delete', old.iD, old.tags, old.note);
+            END;
+            CREATE TRIGGER "{db_table}_fts_au" AFTER UPDATE ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"("{fts_table}", rowid, tags, note)
+                VALUES ('delete', old.iD, old.tags, old.note);
+                INSERT INTO "{fts_table}"(rowid, tags, note)
+                VALUES (new.iD, new.tags, new.note);
+            END;
+            INSERT INTO "{fts_table}"("{fts_table}") VALUES ('rebuild');
+            """,
+            # 2: One row per tag and note, indexed on the tag (case-insensitive).
+            # `tags` stays on the note as a cache, the backfill splits it in SQL.
+            f"""
+            CREATE TABLE "note_tags" (
+                "note_id"	INTEGER NOT NULL,
+                "tag"	TEXT NOT NULL COLLATE NOCASE,
+                PRIMARY KEY("tag", "note_id")
+                ) WITHOUT ROWID;
+            CREATE INDEX "note_tags_note_id" ON "note_tags" ("note_id");
+            CREATE TRIGGER "{db_table}_tags_ad" AFTER DELETE ON "{db_table}" BEGIN
+                DELETE FROM "note_tags" WHERE note_id = old.iD;
+            END;
+            INSERT OR IGNORE INTO "note_tags" (note_id, tag)
+            WITH RECURSIVE split(note_id, tag, rest) AS (
+                SELECT iD, '', tags || ';' FROM "{db_table}" WHERE tags IS NOT NULL
+                UNION ALL
+                SELECT note_id, trim(substr(rest, 1, instr(rest, ';') - 1), ' #'),
+                    substr(rest, instr(rest, ';') + 1)
+                FROM split WHERE instr(rest, ';') > 0
+                )
+            SELECT note_id, tag FROM split WHERE tag <> '';
+            """,
+            # 3: Index for the book/chapter/part folders and a summary of them (note_tree),
+            # one row per folder with the number of notes and the latest date, kept by triggers.
+            f"""
+            CREATE INDEX "{db_table}_book_chapter_part_date" ON "{db_table}" (book, chapter, part, date);
+            CREATE TABLE "note_tree" (
+                "book"	TEXT NOT NULL,
+                "chapter"	TEXT NOT NULL,
+                "part"	TEXT NOT NULL,
+                "note_count"	INTEGER NOT NULL,
+                "last_date"	TEXT,
+                PRIMARY KEY("book", "chapter", "part")
+                ) WITHOUT ROWID;
+            CREATE TRIGGER "{db_table}_tree_ai" AFTER INSERT ON "{db_table}" BEGIN
+                {tree_add.format(row='new')}
+            END;
+            CREATE TRIGGER "{db_table}_tree_ad" AFTER DELETE ON "{db_table}" BEGIN
+                {tree_remove.format(row='old')}
+            END;
+            CREATE TRIGGER "{db_table}_tree_au" AFTER UPDATE OF book, chapter, part, date ON "{db_table}" BEGIN
+                {tree_remove.format(row='old')}
+                {tree_add.format(row='new')}
+            END;
+            INSERT INTO "note_tree" (book, chapter, part, note_count, last_date)
+            SELECT book, chapter, ifnull(part, ''), count(*), max(date) FROM "{db_table}"
+            GROUP BY book, chapter, ifnull(part, '');
+            """,
+            # 4: Index for listing all notes by date, page by page.
+            f"""
+            CREATE INDEX "{db_table}_date" ON "{db_table}" (date);
+            """,
+            # 5: created_ts, the date and time as UTC epoch seconds (date and time are in the `timezone`
+            # of the config), indexed for date ranges. utc_ts() is made in connect().
+            # The full-text index is only updated when tags or note change, not for the backfill.
+            f"""
+            DROP TRIGGER "{db_table}_fts_au";
+            ALTER TABLE "{db_table}" ADD COLUMN "created_ts" INTEGER;
+            UPDATE "{db_table}" SET created_ts = utc_ts(date, time);
+            CREATE INDEX "{db_table}_created_ts" ON "{db_table}" (created_ts);
+            CREATE TRIGGER "{db_table}_fts_au" AFTER UPDATE OF tags, note ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"("{fts_table}", rowid, tags, note)
+                VALUES ('delete', old.iD, old.tags, old.note);
+                INSERT INTO "{fts_table}"(rowid, tags, note)
+                VALUES (new.iD, new.tags, new.note);
+            END;
+            """,
+            # 6: The full-text index reads the notes through the view {db_table}_text, so that it can
+            # be switched to unpack compressed notes (see `text_sql()`). Until then it is plain SQL.
+            # Ends with a rebuild of the index (from the view).
+            f"""
+            DROP TRIGGER "{db_table}_fts_ai";
+            DROP TRIGGER "{db_table}_fts_ad";
+            DROP TRIGGER "{db_table}_fts_au";
+            DROP TABLE "{fts_table}";
+            CREATE VIRTUAL TABLE "{fts_table}" USING fts5(
+                tags, note,
+                content='{db_table}_text', content_rowid='iD',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+            {self.text_sql(False)}
+            INSERT INTO "{fts_table}"("{fts_table}") VALUES ('rebuild');
+            """,
+            # 7: The delete and update triggers of note_tree take the latest date from the notes with a NULL
+            # part and the ones with '' together, like the folder itself. The dates are made again.
+            f"""
+            DROP TRIGGER "{db_table}_tree_ad";
+            DROP TRIGGER "{db_table}_tree_au";
+            CREATE TRIGGER "{db_table}_tree_ad" AFTER DELETE ON "{db_table}" BEGIN
+                {tree_remove.format(row='old')}
+            END;
+            CREATE TRIGGER "{db_table}_tree_au" AFTER UPDATE OF book, chapter, part, date ON "{db_table}" BEGIN
+                {tree_remove.format(row='old')}
+                {tree_add.format(row='new')}
+            END;
+            UPDATE "note_tree" SET last_date = (SELECT max(date) FROM "{db_table}" AS notes
+                WHERE notes.book = note_tree.book AND notes.chapter = note_tree.chapter
+                AND ifnull(notes.part, '') = note_tree.part);
+            """,
+        ]
+        return migrations
+
+    def text_sql(self, packed):
+        """The SQL of the view the full-text index reads the notes through and of the triggers that keep it.
+        With `packed` the notes go through note_text() (made in `connect()`) so compressed ones are indexed
+        as text - a DB like that can only be written to from obsN, plain SQL gets "no such function"."""
+        db_table = self.db_table
+        fts_table = f"{db_table}_fts"
+        old_note, new_note = ("note_text(old.note)", "note_text(new.note)") if packed else ("old.note", "new.note")
+        return f"""
+            CREATE VIEW "{db_table}_text" AS SELECT iD, tags, {"note_text(note) AS note" if packed else "note"}
+                FROM "{db_table}";
+            CREATE TRIGGER "{db_table}_fts_ai" AFTER INSERT ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"(rowid, tags, note)
+                VALUES (new.iD, new.tags, {new_note});
+            END;
+            CREATE TRIGGER "{db_table}_fts_ad" AFTER DELETE ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"("{fts_table}", rowid, tags, note)
+                VALUES ('delete', old.iD, old.tags, {old_note});
+            END;
+            CREATE TRIGGER "{db_table}_fts_au" AFTER UPDATE OF tags, note ON "{db_table}" BEGIN
+                INSERT INTO "{fts_table}"("{fts_table}", rowid, tags, note)
+                VALUES ('delete', old.iD, old.tags, {old_note});
+                INSERT INTO "{fts_table}"(rowid, tags, note)
+                VALUES (new.iD, new.tags, {new_note});
+            END;"""
+
+    def text_index(self, packed):
+        """Switches the full-text index to read the notes `packed` or as they are (see `text_sql()`).
+        The text is the same, so the index itself stays. It is only switched back when no compressed
+        note is left. Returns True if it was switched."""
+        db_table = self.db_table
+        conn = self.connect()
+        view = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?",
+                            (f"{db_table}_text",)).fetchone()
+        if view is None or ("note_text(" in view[0]) == packed:
+            return False
+        if not packed and conn.execute(f"""SELECT 1 FROM '{db_table}' WHERE typeof(note) = 'blob' LIMIT 1""").fetchone():
+            return False
+        log(3, f" - full-text index {'unpacks' if packed else 'reads'} the notes")
+        with conn:
+            conn.executescript(f"""BEGIN IMMEDIATE;
+                DROP VIEW "{db_table}_text";
+                DROP TRIGGER IF EXISTS "{db_table}_fts_ai";
+                DROP TRIGGER IF EXISTS "{db_table}_fts_ad";
+                DROP TRIGGER IF EXISTS "{db_table}_fts_au";
+                {self.text_sql(packed)}
+                COMMIT;""")
+        return True
+
+    @traced
+    def migrate(self):
+        """Brings the database up to date with `migrations()`.
+        The version is kept in `PRAGMA user_version`, every migration runs in its own transaction.
+        A bulk load that was cut off is finished (see `finish_bulk()`) and with `compress_notes` set
+        the full-text index is switched to unpack the notes (see `text_index()`)."""
+        conn = self.connect()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        migrations = self.migrations()
+        for number in range(version + 1, len(migrations) + 1):
+            log(3, f" - migrating db to version {number}")
+            with conn:
+                conn.executescript(f"""BEGIN;
+                    {migrations[number - 1]}
+                    PRAGMA user_version = {number};
+                    COMMIT;""")
+        self.finish_bulk()
+        if self.cfg['compress_notes']:
+            self.text_index(True)
+
+    def pack(self, note):
+        """The note as it is stored: compressed if `compress_notes` (zlib or lzma) is set in the config
+        and it is at least `compress_min_bytes` long (see `pack_note()`)"""
+        return pack_note(note, self.cfg['compress_notes'], int(self.cfg['compress_min_bytes']))
+
+    @traced
+    def write(self, book, chapter, part, date, the_time, tags, note):
+        """Writes a note (tags as "a;b;c;") in one transaction and returns its iD"""
+        conn = self.connect()
+        with conn:  # one transaction, rolled back if anything fails
+            cur = conn.cursor()
+            cur.execute(f"""INSERT INTO '{self.db_table}' (book, chapter, part, date, time, tags, note, created_ts)
+                VALUES (?,?,?,?,?,?,?,?)""",
+                        (only_alnu(book), only_alnu(chapter), only_alnu(part), date, the_time, tags,
+                         self.pack(note), to_ts(date, the_time, self.cfg['timezone'])))
+            write_tags(cur, cur.lastrowid, tags)
+        log(2, " - committed")
+        return cur.lastrowid
+
+    def write_log(self, line, book="notes", chapter="journal", part="log"):
+        """Writes a log line written now (#tags are taken out, see `log_to_note()`) and returns its iD,
+        False if the line is shorter than 3 characters"""
+        if len(line) <= 2:
+            return False
+        return self.write(*log_to_note(book, chapter, part, line, tz_name=self.cfg['timezone']))
+
+    @traced
+    def write_many(self, notes):
+        """Writes a list of notes (the arguments of `write()` as tuples) in one transaction.
+        The iD's are given here (the write lock is held from the start) so that the tags
+        can be written with executemany as well. All or nothing, returns the iD's of the notes (a range).
+        From `bulk_rows` notes on the insert triggers of the full-text index and note_tree are
+        dropped for the transaction and their work is done once for all the rows (about 4x faster)."""
+        conn = self.connect()
+        db_table = self.db_table
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            first_id = conn.execute(f"""SELECT max(
+                ifnull((SELECT seq FROM sqlite_sequence WHERE name = ?), 0),
+                ifnull((SELECT max(iD) FROM '{db_table}'), 0)) + 1""", (db_table,)).fetchone()[0]
+            tz_name = self.cfg['timezone']
+            pack = self.pack
+            rows = [(first_id + i, only_alnu(book), only_alnu(chapter), only_alnu(part), date, the_time, tags,
+                     pack(note), to_ts(date, the_time, tz_name))
+                    for i, (book, chapter, part, date, the_time, tags, note) in enumerate(notes)]
+            triggers = []
+            if len(rows) >= bulk_rows:
+                triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN (?,?)",
+                                        (f"{db_table}_fts_ai", f"{db_table}_tree_ai")).fetchall()
+                for name, sql in triggers:
+                    conn.execute(f'DROP TRIGGER "{name}"')
+            conn.executemany(f"""INSERT INTO '{db_table}' (iD, book, chapter, part, date, time, tags, note, created_ts)
+                VALUES (?,?,?,?,?,?,?,?,?)""", rows)
+            conn.executemany("INSERT OR IGNORE INTO note_tags (note_id, tag) VALUES (?,?)",
+                             [(row[0], tag) for row in rows for tag in split_tags(row[6])])
+            if triggers:
+                new_ids = (first_id, first_id + len(rows) - 1)
+                conn.execute(f"""INSERT INTO "{db_table}_fts" (rowid, tags, note)
+                    SELECT iD, tags, note FROM "{db_table}_text" WHERE iD BETWEEN ? AND ?""", new_ids)
+                conn.execute(f"""INSERT INTO "note_tree" (book, chapter, part, note_count, last_date)
+                    SELECT book, chapter, ifnull(part, ''), count(*), max(date) FROM "{db_table}"
+                    WHERE iD BETWEEN ? AND ? GROUP BY book, chapter, ifnull(part, '') ORDER BY 1, 2, 3
+                    ON CONFLICT (book, chapter, part) DO UPDATE
+                    SET note_count = note_count + excluded.note_count,
+                        last_date = max(ifnull(last_date, ''), excluded.last_date)""", new_ids)
+                for name, sql in triggers:
+                    conn.execute(sql)
+        log(2, f" - {len(rows)} notes committed")
+        if tracing:
+            trace_add("NotesStore.write_many", len(rows), sum(len(row[7] or "") for row in rows), calls=0)
+        return range(first_id, first_id + len(rows))
+
+    @traced
+    def write_log_stream(self, lines, stamped=False, book="notes", chapter="journal", part="log"):
+        """Writes every line of an iterable (a file, stdin) as a log, `ingest_batch` lines per transaction.
+        Tags are taken out like in `write_log()`, with `stamped` a leading timestamp (see `split_stamp()`)
+        gives the date and time of the line. Lines shorter than 3 characters are skipped.
+        Returns the number of notes written - the batches before a failing one stay written."""
+        count = 0
+        batch = []
+        tz_name = self.cfg['timezone']
+        now_date, now_time = get_date(tz_name), get_time(tz_name)
+        for line in lines:
+            line = line.rstrip("\r\n")
+            date, the_time = now_date, now_time
+            if stamped:
+                date, the_time, line = split_stamp(line, tz_name)
+            if len(line) > 2:
+                batch.append(log_to_note(book, chapter, part, line, date or now_date, the_time or now_time))
+            if len(batch) >= self.cfg['ingest_batch']:
+                count += len(self.write_many(batch))
+                batch = []
+                now_date, now_time = get_date(tz_name), get_time(tz_name)
+        if batch:
+            count += len(self.write_many(batch))
+        log(2, f" - {count} lines written")
+        if tracing:
+            trace_add("NotesStore.write_log_stream", count, calls=0)
+        return count
+
+    @traced
+    def update(self, the_id, book, chapter, part, date, the_time, tags, note):
+        """Replaces everything of the note `the_id` (and its tags) in one transaction"""
+        conn = self.connect()
+        with conn:
+            cur = conn.cursor()
+            cur.execute(f"""UPDATE '{self.db_table}'
+                SET book = ?, chapter = ?, part = ?, date = ?, time = ?, tags = ?, note = ?, created_ts = ?
+                WHERE iD = ?""", (book, chapter, part, date, the_time, tags, self.pack(note),
+                                  to_ts(date, the_time, self.cfg['timezone']), the_id))
+            write_tags(cur, the_id, tags)
+        log(2, " - db updated")
+
+    @traced
+    def compress(self, method=None, chunk=1000):
+        """Stores the notes that are already in the DB the way `method` (default `compress_notes`
+        in the config, '' unpacks them all again) would store new ones, `chunk` notes per transaction.
+        The text doesn't change, so the full-text trigger is dropped while doing it.
+        The full-text index unpacks the notes from the first compressed one on and reads them as they are
+        again when all are unpacked (see `text_index()`).
+        Returns (notes changed, bytes of those notes before, bytes after) - the file itself only
+        gets smaller with a VACUUM."""
+        method = self.cfg['compress_notes'] if method is None else method
+        min_bytes = int(self.cfg['compress_min_bytes'])
+        db_table = self.db_table
+        conn = self.connect()
+        if method:
+            self.text_index(True)
+        changed = before = after = 0
+        last_id = 0
+        while True:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                rows = conn.execute(f"""SELECT iD, note FROM '{db_table}'
+                    WHERE iD > ? AND (typeof(note) = 'blob' OR length(note) * 4 >= ?)
+                    ORDER BY iD LIMIT ?""", (last_id, min_bytes, chunk)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                updates = []
+                for the_id, note in rows:
+                    new_note = pack_note(note_text(note), method, min_bytes)
+                    if new_note != note:
+                        updates.append((new_note, the_id))
+                        before += len(note.encode("utf-8") if isinstance(note, str) else note)
+                        after += len(new_note.encode("utf-8") if isinstance(new_note, str) else new_note)
+                if updates:
+                    trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                                           (f"{db_table}_fts_au",)).fetchone()
+                    conn.execute(f'DROP TRIGGER "{db_table}_fts_au"')
+                    conn.executemany(f"UPDATE '{db_table}' SET note = ? WHERE iD = ?", updates)
+                    conn.execute(trigger[0])
+                    changed += len(updates)
+            log(2, f" - {changed} notes changed, up to iD {last_id}")
+        if not method:
+            self.text_index(False)
+        return changed, before, after
+
+    def get(self, the_id):
+        """Gets the note `the_id` as a row (iD, book, chapter, part, date, time, tags, note, created_ts),
+        None if there is none. A compressed note is unpacked."""
+        row = self.query(f"SELECT * FROM '{self.db_table}' WHERE iD = ?", (the_id,)).fetchone()
+        return row if row is None else (*row[:7], note_text(row[7]), *row[8:])
+
+    @traced
+    def query(self, sql_q, params=()):
+        """Runs a query and returns the cursor"""
+        return self.connect().execute(sql_q, params)
+
+    @traced
+    def page(self, sql_q, params, order, after=None, before=None, limit=None):
+        """Gets one page of the rows from `sql_q` (a SELECT without ORDER BY).
+        `order` are the columns the rows are ordered by, together unique (so end with iD).
+        `after`/`before` are the key (values of the `order` columns) of the last/first row of
+        the page you come from. The query starts right at that key (keyset pagination) instead
+        of skipping rows with OFFSET, so a page is as fast at the end as at the start.
+        Returns (rows, key of the first row, key of the last row) - keys are None for no rows."""
+        limit = int(limit or self.cfg['page_size'])
+        columns = ", ".join(order)
+        marks = ", ".join("?" * len(order))
+        params = list(params)
+        if before is not None:
+            sql_q = f"""SELECT * FROM ({sql_q}) WHERE ({columns}) < ({marks})
+                ORDER BY {", ".join(f"{column} DESC" for column in order)} LIMIT ?"""
+            params += [*before, limit]
+        elif after is not None:
+            sql_q = f"SELECT * FROM ({sql_q}) WHERE ({columns}) > ({marks}) ORDER BY {columns} LIMIT ?"
+            params += [*after, limit]
+        else:
+            sql_q = f"SELECT * FROM ({sql_q}) ORDER BY {columns} LIMIT ?"
+            params.append(limit)
+        result = self.query(sql_q, params)
+        rows = result.fetchall()
+        if not rows:
+            return [], None, None
+        if before is not None:
+            rows.reverse()
+        names = [column[0] for column in result.description]
+        key_index = [names.index(column) for column in order]
+        first = tuple(rows[0][i] for i in key_index)
+        last = tuple(rows[-1][i] for i in key_index)
+        return rows, first, last
+
+    def day_range(self, since=None, until=None):
+        """The WHERE for the notes from the start of the day `since` to the end of the day `until`
+        (local dates as 2024-01-31, None = no limit) on the created_ts index, as (where, params).
+        Raises ValueError for a date that can't be read."""
+        tz_name = self.cfg['timezone']
+        where = ["created_ts IS NOT NULL"]
+        params = []
+        for date, sign in ((since, ">="), (until and next_day(until), "<")):
+            if date:
+                start = to_ts(date, "00:00:00", tz_name)
+                if start is None:
+                    raise ValueError(f"Not a date: {date}")
+                where.append(f"created_ts {sign} ?")
+                params.append(start)
+        return " AND ".join(where), params
+
+    def between(self, since=None, until=None):
+        """Gets the notes from the day `since` through the day `until` (see `day_range()`)
+        as a cursor, oldest first"""
+        where, params = self.day_range(since, until)
+        return self.query(f"SELECT * FROM '{self.db_table}' WHERE {where} ORDER BY created_ts, iD", params)
+
+    def on_this_day(self, date=None):
+        """Gets the notes written on this day (or the month and day of `date`) in the years before, oldest first.
+        One range on the created_ts index for every year since the first note."""
+        date = date or get_date(self.cfg['timezone'])
+        first = self.query(f"SELECT min(created_ts) FROM '{self.db_table}'").fetchone()[0]
+        if first is None:
+            return []
+        month, day = int(date[5:7]), int(date[8:10])
+        ranges = []
+        params = []
+        for year in range(time.gmtime(first).tm_year, int(date[:4])):
+            try:
+                that_day = datetime.date(year, month, day).isoformat()
+            except ValueError:
+                continue  # no 29th of February that year
+            where, day_params = self.day_range(that_day, that_day)
+            ranges.append(f"SELECT * FROM '{self.db_table}' WHERE {where}")
+            params += day_params
+        if not ranges:
+            return []
+        return self.query(f"{' UNION ALL '.join(ranges)} ORDER BY created_ts, iD", params).fetchall()
+
+    def timeline(self, since=None, until=None):
+        """Gets the number of notes of every day from `since` through `until` (see `day_range()`)
+        as a list of (date, number of notes)"""
+        where, params = self.day_range(since, until)
+        return self.query(f"""SELECT date, count(*) FROM '{self.db_table}' WHERE {where}
+            GROUP BY date ORDER BY date""", params).fetchall()
+
+    def books(self):
+        """Gets a list of all the books as (book, number of notes)"""
+        return self.query("""SELECT book, sum(note_count) FROM note_tree
+            GROUP BY book ORDER BY book""").fetchall()
+
+    def chapters(self, book):
+        """Gets all the chapters in the given book as (chapter, number of notes)"""
+        return self.query("""SELECT chapter, sum(note_count) FROM note_tree
+            WHERE book = ? GROUP BY chapter ORDER BY chapter""", (book,)).fetchall()
+
+    def parts(self, book, chapter):
+        """Gets all the parts of the given chapter in the given book as (part, number of notes)"""
+        return self.query("""SELECT part, note_count FROM note_tree
+            WHERE book = ? AND chapter = ? ORDER BY part""", (book, chapter)).fetchall()
+
+    def notes(self, book, chapter, part, after=None, before=None, limit=None):
+        """Gets a page (see `page()`) of the notes in the given part of the given chapter
+        in the given book, oldest first. The part '' (as in note_tree) is also the notes without a part."""
+        part_q = "part = ?" if part else "(part = ? OR part IS NULL)"
+        sql_q = f"SELECT * FROM '{self.db_table}' WHERE book = ? AND chapter = ? AND {part_q}"
+        return self.page(sql_q, (book, chapter, part or ""), ("date", "iD"), after, before, limit)
+
+    def tag_query(self, tag_str):
+        """Turns a tag expression into a query for the iD's of the matching notes.
+        Tags next to each other (or with AND between) must all be on the note,
+        OR separates alternatives and NOT (or -tag) excludes a tag:
+            `python work OR home NOT draft` = (python and work) or (home but not draft)
+        Every tag is looked up with the index on `note_tags`. Returns (sql_q, params)."""
+        groups = [[]]
+        negate = False
+        for word in tag_str.split():
+            if word.upper() in ("OR", "|"):
+                groups.append([])
+            elif word.upper() == "NOT":
+                negate = True
+            elif word.upper() != "AND":
+                if word.startswith("-"):
+                    negate = True
+                tag = word.strip(" #-")
+                if tag:
+                    groups[-1].append((negate, tag))
+                negate = False
+        selects = []
+        params = []
+        for group in groups:
+            if not group:
+                continue
+            parts = [("INTERSECT", tag) for negated, tag in group if not negated]
+            parts += [("EXCEPT", tag) for negated, tag in group if negated]
+            if parts[0][0] == "INTERSECT":
+                sql_q = "SELECT note_id FROM note_tags WHERE tag = ?"
+                params.append(parts.pop(0)[1])
+            else:
+                sql_q = f"SELECT iD FROM '{self.db_table}'"
+            for operator, tag in parts:
+                sql_q += f" {operator} SELECT note_id FROM note_tags WHERE tag = ?"
+                params.append(tag)
+            selects.append(f"SELECT * FROM ({sql_q})")
+        return " UNION ".join(selects), params
+
+    def find_tags(self, tag_str):
+        """Gets the notes matching a tag expression (see `tag_query()`), oldest first, as a cursor"""
+        ids_q, params = self.tag_query(tag_str)
+        if not ids_q:
+            return None
+        return self.query(f"SELECT * FROM '{self.db_table}' WHERE iD IN ({ids_q}) ORDER BY iD", params)
+
+    @traced
+    def search(self, srch_str, after=None, before=None, limit=None):
+        """Searches the full-text index (see `fts_query()`) and returns one page of hits (see `page()`),
+        best match first. The note column is a snippet with the matched words *highlighted*."""
+        fts_table = f"{self.db_table}_fts"
+        query = fts_query(srch_str)
+        if not query:
+            return [], None, None
+        sql_q = f"""SELECT n.iD, n.book, n.chapter, n.part, n.date, n.time, n.tags,
+                snippet("{fts_table}", 1, '*', '*', '...', 8) AS note,
+                bm25("{fts_table}") AS score
+            FROM "{fts_table}" JOIN '{self.db_table}' AS n ON n.iD = "{fts_table}".rowid
+            WHERE "{fts_table}" MATCH ?"""
+        return self.page(sql_q, (query,), ("score", "iD"), after, before, limit)
+
+    @traced
+    def search_tags(self, tag_str, after=None, before=None, limit=None):
+        """Finds notes by a tag expression (see `tag_query()`) and returns one page (see `page()`), oldest first"""
+        ids_q, params = self.tag_query(tag_str)
+        if not ids_q:
+            return [], None, None
+        sql_q = f"SELECT * FROM '{self.db_table}' WHERE iD IN ({ids_q})"
+        return self.page(sql_q, params, ("iD",), after, before, limit)
+
+    @traced
+    def export(self, sql_q=None, params=(), workers=None):
+        """Exports the notes from `sql_q` (default: all of them) as markdown files to the export folder
+        (book/chapter/part/date_iD.md) and returns the number of files written.
+        The folders are made up front (one query for the distinct book/chapter/part, listing what
+        is already in them), then the rendered rows go through a bounded queue to `workers`
+        threads (default `export_workers` in the config) that write the files - the open/write/close
+        syscalls run side by side while the next rows are rendered.
+        Files that already exist are left alone."""
+        import queue
+        import threading
+        sql_q = sql_q or f"SELECT * FROM '{self.db_table}'"
+        export_folder = self.export_folder
+        workers = int(workers or self.cfg['export_workers'])
+        existing = set()
+        for book, chapter, part in self.query(f"SELECT DISTINCT book, chapter, part FROM ({sql_q})", params):
+            folder = f"{book}/{chapter}/{part}"
+            try:
+                os.makedirs(f"{export_folder}/{folder}", exist_ok=True)
+                existing.update(f"{folder}/{name}" for name in os.listdir(f"{export_folder}/{folder}"))
+            except OSError as error:
+                log(1, f"NotesStore.export() os.makedirs had an error: {error}")
+        rows = queue.Queue(maxsize=workers * 4)  # holds batches of rendered rows
+        written = [0] * workers
+
+        def write_rows(worker):
+            while True:
+                batch = rows.get()
+                if batch is None:
+                    return
+                for path, write_data in batch:
+                    try:
+                        with open(f"{export_folder}/{path}", "w", encoding="utf-8") as f:
+                            f.write(write_data)
+                        written[worker] += 1
+                    except OSError as error:
+                        log(1, f"NotesStore.export() could not write {path}: {error}")
+
+        threads = [threading.Thread(target=write_rows, args=(worker,), daemon=True) for worker in range(workers)]
+        for thread in threads:
+            thread.start()
+        batch = []
+        try:
+            for row in self.query(sql_q, params):
+                path = export_path(row)
+                if path not in existing:
+                    batch.append((path, gen_write_data(row)))
+                    if len(batch) == 64:
+                        rows.put(batch)
+                        batch = []
+            if batch:
+                rows.put(batch)
+        finally:  # the writers finish what they got and stop, also when rendering failed
+            for thread in threads:
+                rows.put(None)
+            for thread in threads:
+                thread.join()
+        if tracing:
+            trace_add("NotesStore.export", sum(written), calls=0)
+        return sum(written)
+
+    def export_rows(self, sql_q=None, params=()):
+        """The notes from `sql_q` (default: all of them) as dicts for the bulk exports, one at a time
+        from the cursor: iD, book, chapter, part, date, time, tags (a list), note (unpacked) and created_ts"""
+        sql_q = sql_q or f"SELECT * FROM '{self.db_table}'"
+        for the_id, book, chapter, part, date, the_time, tags, note, created_ts in self.query(
+                f"SELECT iD, book, chapter, part, date, time, tags, note, created_ts FROM ({sql_q})", params):
+            yield {'iD': the_id, 'book': book, 'chapter': chapter, 'part': part, 'date': date, 'time': the_time,
+                   'tags': split_tags(tags), 'note': note_text(note), 'created_ts': created_ts}
+
+    @traced
+    def export_jsonl(self, out, sql_q=None, params=()):
+        """Writes the notes from `sql_q` to the text file `out` as JSON lines, one note per line
+        (see `export_rows()`) - streamed, so any number of notes in constant memory. Returns the count."""
+        import json
+        count = 0
+        for note in self.export_rows(sql_q, params):
+            out.write(json.dumps(note, ensure_ascii=False))
+            out.write("\n")
+            count += 1
+        return count
+
+    @traced
+    def export_csv(self, out, sql_q=None, params=()):
+        """Writes the notes from `sql_q` to `out` (opened with newline="") as CSV with a header,
+        tags joined by ; - streamed like `export_jsonl()`. Returns the count."""
+        import csv
+        columns = ['iD', 'book', 'chapter', 'part', 'date', 'time', 'tags', 'note', 'created_ts']
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        count = 0
+        for note in self.export_rows(sql_q, params):
+            note['tags'] = ";".join(note['tags'])
+            writer.writerow([note[column] for column in columns])
+            count += 1
+        return count
+
+    @traced
+    def export_npz(self, path, sql_q=None, params=()):
+        """Writes the notes from `sql_q` as columns to a NumPy .npz file (numpy is not needed to write it):
+        `id` and `created_ts` (int64, -1 for no timestamp) and for book, chapter, part, tags and note
+        the UTF-8 text of all notes after each other (uint8) with `<column>_offsets` (int64, one more than
+        the notes) - the text of note i is note[note_offsets[i]:note_offsets[i + 1]].
+        The columns are spooled to temporary files while the cursor is read, so memory stays flat.
+        Returns the count."""
+        import array
+        import tempfile
+        import zipfile
+        text_columns = ['book', 'chapter', 'part', 'tags', 'note']
+        little = sys.byteorder == "little"
+        count = 0
+        with tempfile.TemporaryDirectory() as spool:
+            files = {name: open(os.path.join(spool, name), "w+b")
+                     for name in ['id', 'created_ts', *text_columns, *(f"{name}_offsets" for name in text_columns)]}
+            try:
+                offsets = dict.fromkeys(text_columns, 0)
+                numbers = {name: array.array("q") for name in files if name not in text_columns}
+
+                def flush():
+                    for name, values in numbers.items():
+                        if not little:
+                            values.byteswap()
+                        files[name].write(values.tobytes())
+                        del values[:]
+
+                for name in text_columns:
+                    numbers[f"{name}_offsets"].append(0)
+                for note in self.export_rows(sql_q, params):
+                    numbers['id'].append(note['iD'])
+                    numbers['created_ts'].append(note['created_ts'] if note['created_ts'] is not None else -1)
+                    note['tags'] = ";".join(note['tags'])
+                    for name in text_columns:
+                        data = (note[name] or "").encode("utf-8")
+                        files[name].write(data)
+                        offsets[name] += len(data)
+                        numbers[f"{name}_offsets"].append(offsets[name])
+                    count += 1
+                    if count % 10000 == 0:
+                        flush()
+                flush()
+                with zipfile.ZipFile(f"{path}.part", "w", zipfile.ZIP_STORED, allowZip64=True) as npz:
+                    for name, f in files.items():
+                        dtype = "|u1" if name in text_columns else "<i8"
+                        size = f.tell() // (1 if name in text_columns else 8)
+                        header = f"{{'descr': '{dtype}', 'fortran_order': False, 'shape': ({size},), }}"
+                        header += " " * (63 - (len(header) + 10) % 64) + "\n"  # the header ends on 64 bytes
+                        with npz.open(f"{name}.npy", "w", force_zip64=True) as member:
+                            member.write(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1"))
+                            f.seek(0)
+                            while data := f.read(1024 * 1024):
+                                member.write(data)
+            finally:
+                for f in files.values():
+                    f.close()
+        os.replace(f"{path}.part", path)
+        return count
+
+    def bulk_lock(self):
+        """Takes the lock of bulk loads (the file <db file>-bulk) and returns it as an open file,
+        None if another store or process holds it. The OS lets go of it when the process ends,
+        also when it is killed - so a bulk load whose lock is free was cut off."""
+        lock = open(f"{self.db_file}-bulk", "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+        return lock
+
+    def defer_bulk(self):
+        """Drops the insert triggers (full-text index and note_tree) and the indexes of the notes for a bulk load,
+        their SQL is kept in the table bulk_pending until `finish_bulk()` puts them back.
+        The store holds the lock (see `bulk_lock()`) until then, so others leave the load alone
+        (`migrate()` only finishes one that was cut off). Raises sqlite3.OperationalError if
+        another bulk load is running."""
+        conn = self.connect()
+        if self.bulk is None:
+            self.bulk = self.bulk_lock()
+            if self.bulk is None:
+                raise sqlite3.OperationalError("another bulk load is running")
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute('CREATE TABLE IF NOT EXISTS "bulk_pending" ("name" TEXT PRIMARY KEY, "type" TEXT, "sql" TEXT)')
+                objects = conn.execute("""SELECT name, type, sql FROM sqlite_master
+                    WHERE (type = 'trigger' AND name IN (?, ?))
+                    OR (type = 'index' AND tbl_name IN (?, 'note_tags') AND sql IS NOT NULL)""",
+                                       (f"{self.db_table}_fts_ai", f"{self.db_table}_tree_ai", self.db_table)).fetchall()
+                for name, kind, sql in objects:
+                    conn.execute('INSERT OR REPLACE INTO "bulk_pending" VALUES (?,?,?)', (name, kind, sql))
+                    conn.execute(f'DROP {kind.upper()} "{name}"')
+        except sqlite3.Error:
+            self.bulk.close()
+            self.bulk = None
+            raise
+
+    def finish_bulk(self):
+        """Ends a bulk load (see `defer_bulk()`), also one that was cut off: rebuilds the full-text
+        index and note_tree from all the notes and makes the indexes and triggers again, in one transaction.
+        A bulk load that another store or process is still doing is left alone, returns False then."""
+        conn = self.connect()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'bulk_pending'").fetchone() is None:
+            return True
+        lock = self.bulk or self.bulk_lock()
+        if lock is None:
+            log(2, " - a bulk load is running, left alone")
+            return False
+        db_table = self.db_table
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(f"""INSERT INTO "{db_table}_fts"("{db_table}_fts") VALUES ('rebuild')""")
+                conn.execute('DELETE FROM "note_tree"')
+                conn.execute(f"""INSERT INTO "note_tree" (book, chapter, part, note_count, last_date)
+                    SELECT book, chapter, ifnull(part, ''), count(*), max(date) FROM "{db_table}"
+                    GROUP BY book, chapter, ifnull(part, '')""")
+                for (sql,) in conn.execute('SELECT sql FROM "bulk_pending" ORDER BY type, name').fetchall():
+                    conn.execute(sql)
+                conn.execute('DROP TABLE "bulk_pending"')
+        finally:
+            lock.close()
+            self.bulk = None
+        log(2, " - bulk load finished")
+        return True
+
+    @traced
+    def restore(self, source, workers=None, progress=None):
+        """Loads the notes of a backup tar or a folder of exported notes (see `export_entries()`) with their iD's.
+        The files are read as a stream and parsed (`parse_export()`) in `workers` processes (default: one per CPU),
+        the notes are written `ingest_batch` per transaction with the indexes and triggers deferred to the end
+        (see `defer_bulk()`). Notes with an iD that is already in the DB are skipped, notes without an iD are
+        written as new ones. `progress(restored, skipped)` is called after every transaction.
+        Returns (notes restored, notes skipped, names of the files that could not be read)."""
+        import collections
+        import json
+        db_table = self.db_table
+        conn = self.connect()
+        tz_name = self.cfg['timezone']
+        workers = int(workers or os.cpu_count() or 1)
+        restored = skipped = 0
+        failed = []
+        without_id = []
+        batch = {}
+
+        def insert():
+            nonlocal restored, skipped
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                existing = {row[0] for row in conn.execute(f"""SELECT iD FROM '{db_table}'
+                    WHERE iD IN (SELECT value FROM json_each(?))""", (json.dumps(list(batch)),))}
+                rows = [(the_id, only_alnu(book), only_alnu(chapter), only_alnu(part), date, the_time, tags,
+                         self.pack(note), to_ts(date, the_time, tz_name))
+                        for the_id, (book, chapter, part, date, the_time, tags, note) in batch.items()
+                        if the_id not in existing]
+                conn.executemany(f"""INSERT INTO '{db_table}' (iD, book, chapter, part, date, time, tags, note, created_ts)
+                    VALUES (?,?,?,?,?,?,?,?,?)""", rows)
+                conn.executemany("INSERT OR IGNORE INTO note_tags (note_id, tag) VALUES (?,?)",
+                                 [(row[0], tag) for row in rows for tag in split_tags(row[6])])
+            restored += len(rows)
+            skipped += len(existing)
+            batch.clear()
+            if progress:
+                progress(restored, skipped)
+
+        def take(result):
+            nonlocal skipped
+            notes, bad = result
+            failed.extend(bad)
+            for the_id, *note in notes:
+                if the_id is None:
+                    without_id.append(tuple(note))
+                elif the_id not in batch:
+                    batch[the_id] = note
+                else:
+                    skipped += 1  # the same iD twice in one batch: the first one is kept
+            if len(batch) >= self.cfg['ingest_batch']:
+                insert()
+
+        def chunks():
+            chunk = []
+            for entry in export_entries(source):
+                chunk.append(entry)
+                if len(chunk) == 256:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        self.finish_bulk()  # one that was cut off before
+        self.defer_bulk()
+        try:
+            if workers > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(workers) as pool:
+                    parsing = collections.deque()
+                    for chunk in chunks():
+                        parsing.append(pool.submit(parse_export, chunk))
+                        if len(parsing) >= workers * 4:  # keeps the files read ahead (and memory) bounded
+                            take(parsing.popleft().result())
+                    while parsing:
+                        take(parsing.popleft().result())
+            else:
+                for chunk in chunks():
+                    take(parse_export(chunk))
+            if batch:
+                insert()
+        finally:
+            self.finish_bulk()
+        if without_id:
+            restored += len(self.write_many(without_id))
+        return restored, skipped, failed
+
+    def load_manifest(self):
+        """Loads the backup manifest (next to the archives in the backup folder), None if there is none.
+        It holds the full backup (`base`), the incremental ones made after it (`increments`, oldest first)
+        and for every note (by iD) the path it was archived under and a hash of the file."""
+        import json
+        manifest_path = os.path.join(self.backup_folder, "obsNotes_backup_manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        """Writes the backup manifest, through a temporary file so a crash can't leave half a manifest"""
+        import json
+        manifest_path = os.path.join(self.backup_folder, "obsNotes_backup_manifest.json")
+        with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    @traced
+    def replay(self, target):
+        """Rebuilds the markdown files of the latest backup in the folder `target`:
+        extracts the full backup and then every incremental one on top of it, in order,
+        removing the files each of them lists as deleted.
+        Returns the archives that were replayed, None if there is no manifest."""
+        import tarfile
+        manifest = self.load_manifest()
+        if manifest is None:
+            return None
+        os.makedirs(target, exist_ok=True)
+        deleted_list = os.path.join(target, "obsN_deleted.txt")
+        archives = [manifest['base'], *manifest['increments']]
+        for archive in archives:
+            with tarfile.open(archive) as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(target, filter="data")
+                else:
+                    tar.extractall(target)
+            if os.path.exists(deleted_list):
+                with open(deleted_list, encoding="utf-8") as f:
+                    for path in f.read().splitlines():
+                        if os.path.exists(os.path.join(target, path)):
+                            os.remove(os.path.join(target, path))
+                os.remove(deleted_list)
+            log(3, f" - replayed {archive}")
+        return archives
+
+    @traced
+    def backup(self, incremental=False, compression=None):
+        """Archives the DB as markdown files (book/chapter/part/date_iD.md) in a single tar in the backup folder.
+        The notes are rendered straight into the (gz, bz2 or xz compressed) tar stream, one sequential
+        write without any files in the export folder. `compression` defaults to `backup_compression`
+        in the config ('' for a plain tar).
+        The manifest (see `load_manifest()`) gets a hash of every note, so with `incremental` only
+        the notes that are new or changed since the last backup are archived, together with a
+        list (obsN_deleted.txt) of the files that are gone. `replay()` puts them together.
+        Without a manifest the backup is a full one.
+        Returns (path of the archive, number of notes archived, number of files removed)."""
+        import hashlib
+        import tarfile
+        now_date = get_date(self.cfg['timezone'])
+        manifest = self.load_manifest() if incremental else None
+        if manifest is None:
+            archive_path = f"{self.backup_folder}/obsNotes_backup_{str(now_date)}"
+            old_notes = {}
+        else:
+            number = len(manifest['increments']) + 1
+            archive_path = f"{self.backup_folder}/obsNotes_backup_{str(now_date)}_{get_time(self.cfg['timezone']).replace(':', '')}_inc{number}"
+            old_notes = manifest['notes']
+        if compression is None:
+            compression = self.cfg['backup_compression']
+        archive_path += f".tar.{compression}" if compression else ".tar"
+        mtime = time.time()
+        notes = {}
+        i = 0
+        with tarfile.open(f"{archive_path}.part", f"w:{compression}") as tar:
+            for row in self.query(f"SELECT * FROM '{self.db_table}'"):
+                write_data = gen_write_data(row).encode("utf-8")
+                path = export_path(row)
+                notes[str(row[0])] = [path, hashlib.blake2b(write_data, digest_size=16).hexdigest()]
+                if old_notes.get(str(row[0])) != notes[str(row[0])]:
+                    tar_add(tar, path, write_data, mtime)
+                    i += 1
+            deleted = [old[0] for the_id, old in old_notes.items() if notes.get(the_id, [None])[0] != old[0]]
+            if deleted:
+                tar_add(tar, "obsN_deleted.txt", ("\n".join(deleted) + "\n").encode("utf-8"), mtime)
+        os.replace(f"{archive_path}.part", archive_path)
+        if manifest is None:
+            manifest = {'base': archive_path, 'increments': []}
+        else:
+            manifest['increments'].append(archive_path)
+        manifest['notes'] = notes
+        self.save_manifest(manifest)
+        if tracing:
+            trace_add("NotesStore.backup", i, os.path.getsize(archive_path), calls=0)
+        return archive_path, i, len(deleted)
+
+    @traced
+    def backup_db(self, compact=False, progress=None):
+        """Makes a consistent snapshot of the database file in the backup folder (next to the archives
+        from `backup()`) with the SQLite backup API and returns its path. It copies `backup_pages` pages
+        per step and lets go of the database between the steps, so others can keep writing meanwhile
+        (`progress(status, remaining, total)` is called after every step).
+        With `compact` the snapshot is then rewritten with VACUUM INTO (no free pages, smaller file)."""
+        snapshot_path = f"{self.backup_folder}/obsNotes_backup_{get_date(self.cfg['timezone'])}.sqlite"
+        snapshot = sqlite3.connect(f"{snapshot_path}.part")
+        try:
+            with snapshot:
+                self.connect().backup(snapshot, pages=int(self.cfg['backup_pages']), progress=progress, sleep=0.05)
+            snapshot.execute("PRAGMA journal_mode = DELETE")
+            if compact:
+                if os.path.exists(f"{snapshot_path}.vacuum"):
+                    os.remove(f"{snapshot_path}.vacuum")
+                snapshot.execute("VACUUM INTO ?", (f"{snapshot_path}.vacuum",))
+                snapshot.close()
+                os.replace(f"{snapshot_path}.vacuum", f"{snapshot_path}.part")
+        except sqlite3.Error:
+            snapshot.close()
+            os.remove(f"{snapshot_path}.part")
+            raise
+        finally:
+            snapshot.close()
+        os.replace(f"{snapshot_path}.part", snapshot_path)
+        return snapshot_path
+
+
+class AsyncNotesStore:
+    """A `NotesStore` for asyncio code - the database work runs on a thread of its own,
+    so the event loop never waits for sqlite:
+
+        async with obsN.AsyncNotesStore({'main_folder': '/home/me/notes'}) as store:
+            the_id = await store.write_log("Sent from the bot #bot")
+            rows, first, last = await store.search("bot")
+            async for row in store.query("SELECT * FROM obsNotes WHERE book = ?", ("notes",)):
+                ...
+
+    Calls are queued and run one at a time, in order, on the database thread. Single notes
+    (`write()`, `write_log()`) that are waiting in the queue together are written in one
+    transaction (at most `serve_batch` notes), so many tasks writing at once share the commits.
+    If that transaction fails the notes are written one by one, so only a bad note fails its task."""
+
+    def __init__(self, config=None, base_dir=None):
+        import queue
+        self.store = NotesStore(config, base_dir)
+        self.jobs = queue.Queue()
+        self.thread = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def db_thread(self):
+        """Runs the queued jobs (see `submit()`) until `close()`"""
+        import queue
+        waiting = []  # taken from the queue while collecting notes, runs next
+        while True:
+            job = waiting.pop() if waiting else self.jobs.get()
+            if job is None:
+                self.store.close()
+                return
+            function, args, loop, future = job
+            if function is not None:
+                try:
+                    loop.call_soon_threadsafe(self.resolve, future, function(*args), None)
+                except Exception as error:
+                    loop.call_soon_threadsafe(self.resolve, future, None, error)
+                continue
+            notes = [job]
+            while len(notes) < self.store.cfg['serve_batch']:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None or job[0] is not None:
+                    waiting.append(job)
+                    break
+                notes.append(job)
+            try:
+                the_ids = self.store.write_many([args for function, args, loop, future in notes])
+                for (function, args, loop, future), the_id in zip(notes, the_ids):
+                    loop.call_soon_threadsafe(self.resolve, future, the_id, None)
+            except Exception as error:
+                if len(notes) == 1:
+                    function, args, loop, future = notes[0]
+                    loop.call_soon_threadsafe(self.resolve, future, None, error)
+                    continue
+                log(2, f"AsyncNotesStore - the commit of {len(notes)} notes failed ({error!r}), one at a time")
+                for function, args, loop, future in notes:  # only the bad note gets the error
+                    try:
+                        loop.call_soon_threadsafe(self.resolve, future, self.store.write(*args), None)
+                    except Exception as error:
+                        loop.call_soon_threadsafe(self.resolve, future, None, error)
+                continue
+            log(2, f"AsyncNotesStore - {len(notes)} notes in one commit")
+
+    @staticmethod
+    def resolve(future, result, error):
+        """Hands the result (or error) of a job to the task that waits for it"""
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def submit(self, function, *args):
+        """Queues `function(*args)` for the database thread and returns a future for the result.
+        `function` None queues a note (a tuple for `NotesStore.write_many()`) for a group commit."""
+        import asyncio
+        import threading
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.db_thread, daemon=True)
+            self.thread.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.jobs.put((function, args[0] if function is None else args, loop, future))
+        return future
+
+    async def run(self, function, *args):
+        """Runs `function(store, *args)` on the database thread - for everything `NotesStore` has:
+        `await store.run(obsN.NotesStore.books)`"""
+        return await self.submit(function, self.store, *args)
+
+    async def write(self, book, chapter, part, date, the_time, tags, note):
+        """Writes a note (in a group commit) and returns its iD"""
+        return await self.submit(None, (book, chapter, part, date, the_time, tags, note))
+
+    async def write_log(self, line, book="notes", chapter="journal", part="log"):
+        """Writes a log line written now (in a group commit) and returns its iD,
+        False if the line is shorter than 3 characters"""
+        if len(line) <= 2:
+            return False
+        return await self.submit(None, log_to_note(book, chapter, part, line, tz_name=self.store.cfg['timezone']))
+
+    async def write_many(self, notes):
+        """Writes a list of notes in one transaction and returns their iD's"""
+        return await self.submit(self.store.write_many, notes)
+
+    async def update(self, the_id, book, chapter, part, date, the_time, tags, note):
+        """Replaces everything of the note `the_id`"""
+        return await self.submit(self.store.update, the_id, book, chapter, part, date, the_time, tags, note)
+
+    async def get(self, the_id):
+        """Gets the note `the_id` as a row, None if there is none"""
+        return await self.submit(self.store.get, the_id)
+
+    async def search(self, srch_str, after=None, before=None, limit=None):
+        """Searches the full-text index and returns one page of hits (see `NotesStore.search()`)"""
+        return await self.submit(self.store.search, srch_str, after, before, limit)
+
+    async def search_tags(self, tag_str, after=None, before=None, limit=None):
+        """Finds notes by a tag expression and returns one page (see `NotesStore.search_tags()`)"""
+        return await self.submit(self.store.search_tags, tag_str, after, before, limit)
+
+    async def query(self, sql_q, params=(), batch=100):
+        """Runs a query and yields the rows (`async for`), fetched `batch` rows at a time on the database thread"""
+        cursor = await self.submit(self.store.query, sql_q, params)
+        while True:
+            rows = await self.submit(cursor.fetchmany, batch)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    async def close(self):
+        """Writes what is still queued and closes the connection (the store can be used again after)"""
+        import asyncio
+        if self.thread is not None:
+            self.jobs.put(None)
+            await asyncio.to_thread(self.thread.join)
+            self.thread = None
+
+
+def get_store():
+    """Gets the store (see `NotesStore`) of this run, made from `cfg` on the first call"""
+    global store
+    if store is None:
+        store = NotesStore(cfg, script_dir)
+    return store
+
+
+def get_conn():
+    """Gets the connection to the database (see `NotesStore.connect()`)"""
+    return get_store().connect()
+
+
+def close_conn():
+    """Closes the connection to the database"""
+    if store is not None:
+        store.close()
+
+
+@traced
+def create_db():
+    """Creates the notes table and brings it up to date with the migrations"""
+    get_store().create()
+
+
+@traced
+def get_page(sql_q, params, order, after=None, before=None, limit=None):
+    """Gets one page of the rows from `sql_q` (see `NotesStore.page()`),
+    returns (rows, key of the first row, key of the last row)"""
+    try:
+        return get_store().page(sql_q, params, order, after, before, limit)
+    except sqlite3.Error as error:
+        log(2, f"get_page() had an except (sqlite3.error): {error}")
+        return [], None, None
+
+
+def key_to_str(key):
+    """Turns a page key into a string for the command line (--after)"""
+    return ",".join(str(value) for value in key)
+
+
+def str_to_key(key_str):
+    """Turns a --after string back into a page key"""
+    key = []
+    for value in key_str.split(","):
+        for number in (int, float):
+            try:
+                value = number(value)
+                break
+            except ValueError:
+                pass
+        key.append(value)
+    return tuple(key)
+
+
+@traced
+def get_things(sql_q, params=()):
     """Gets things from the database and returns the cursor"""
-    log(2, "get_things()")
     try:
-        conn = sqlite3.connect(db_file)
-        log(2, " - Connected to db")
-        cur = conn.cursor()
-        cur.execute(sql_q)
-        log(2, " - sql executed, returning cursor")
-        return cur
+        return get_store().query(sql_q, params)
     except sqlite3.Error as error:
         log(2, f"get_things() had an except (sqlite3.error): {error}")
 
 
-def export_things_md(sql_q):
-    """Export from DB to file based on sql_q - a sql query."""
-    log(2, "export_things()")
-    result = get_things(sql_q)
-    i = 0
-    for row in result:
-        write_data = gen_write_data(row)
-        clean_date = row[4].replace(":", "-")
-        folder_path = f"{export_folder}/{row[1]}/{row[2]}/{row[3]}/"
-        if not os.path.exists(folder_path):
-            try:  
-                os.makedirs(folder_path)
-                log(2, " - Folder did not exist - created")
-            except OSError as error:  
-                log(1, f"export_things() os.mkdir had an error: {error}")
-        path = f"{folder_path}{clean_date}_{row[0]}.md"
-        if not os.path.exists(path):
-            f = open(path, "w", encoding="utf-8")
-            f.write(write_data)
-            f.close()
-            log(2, f" - exported file ({i})")
-            i += 1
-    print(f" Exported a total of {i} files.")
+def export_path(row):
+    """The path (in the export folder) a database row is exported to: book/chapter/part/date_iD.md"""
+    clean_date = row[4].replace(":", "-")
+    return f"{row[1]}/{row[2]}/{row[3]}/{clean_date}_{row[0]}.md"
+
 
+@traced
+def export_things_md(sql_q, params=(), workers=None):
+    """Export from DB to file based on sql_q - a sql query (see `NotesStore.export()`)"""
+    start = time.perf_counter()
+    i = get_store().export(sql_q, params, workers)
+    seconds = time.perf_counter() - start
+    print(f" Exported a total of {i} files in {seconds:.2f}s ({i / max(seconds, 0.001):.0f} files/s).")
+    return i
 
+
+@traced
 def export_for_edit(the_id):
     """Exports a DB-entry by iD  to a cashe file for edit."""
-    log(2, "export_for_edit(the_id)")
     the_file = f"cache_{the_id}.md"
     path = os.path.join(cache_folder, the_file)
     sql_q = f"SELECT * FROM '{db_table}' WHERE iD = '{the_id}'"
@@ -429,71 +2369,232 @@ def export_for_edit(the_id):
     return path
 
 
-def export_selection(choice, selection):
-    """export to file based on selection"""
-    log(2, "export_selection()")
-    sql_q = "not"
+@traced
+def selection_query(choice, selection):
+    """The notes to export for a selection (see `export_selection()`) as (sql_q, params), sql_q is None
+    for a choice it doesn't know"""
+    sql_q = None
+    params = ()
     match choice:
         case "tag":
-            sql_q = f"SELECT * FROM '{db_table}' WHERE tags LIKE '%{selection}%'"
+            ids_q, params = tag_query(selection)
+            sql_q = f"SELECT * FROM '{db_table}' WHERE iD IN ({ids_q})"
             log(2, " - tag")
         case "book":
-            sql_q = f"SELECT * FROM '{db_table}' WHERE book = '{selection}'"
+            sql_q = f"SELECT * FROM '{db_table}' WHERE book = ?"
+            params = (selection,)
             log(2, " - book")
         case "chapter":
-            selection = selection.split(";")
-            sql_q = f"SELECT * FROM '{db_table}' WHERE book = '{selection[1]}' AND chapter = '{selection[2]}'"
+            selection = selection.split(";") + ["", ""]
+            sql_q = f"SELECT * FROM '{db_table}' WHERE book = ? AND chapter = ?"
+            params = (selection[1], selection[2])
             log(2, " - chapter")
         case "part":
             log(2, " - part")
-            selection = selection.split(";")
+            selection = selection.split(";") + ["", "", ""]
             sql_q = f"""SELECT * FROM '{db_table}' 
-                WHERE book = '{selection[1]}' 
-                AND chapter = '{selection[2]}' 
-                AND part = '{selection[3]}'"""
+                WHERE book = ? 
+                AND chapter = ? 
+                AND part = ?"""
+            params = (selection[1], selection[2], selection[3])
         case "id":
             log(2, " - id")
-            sql_q = f"SELECT * FROM '{db_table}' WHERE iD = '{selection}'"
+            sql_q = f"SELECT * FROM '{db_table}' WHERE iD = ?"
+            params = (selection,)
+        case "all":
+            log(2, " - all")
+            sql_q = f"SELECT * FROM '{db_table}'"
         case _:
-            log(1, f"export_selection() didnt find the choice!")
-    if not sql_q == "not":
-        export_things_md(sql_q)
+            log(1, f"selection_query() didnt find the choice!")
+    return sql_q, params
+
+
+def export_selection(choice, selection, export_format="md", path=None):
+    """export to file based on selection: tag (a tag expression), book, chapter (;book;chapter),
+    part (;book;chapter;part), id or all - as markdown files or one jsonl/csv/npz file (see `export_notes()`)"""
+    sql_q, params = selection_query(choice, selection)
+    if sql_q is None:
+        return False
+    if export_format == "md":
+        return export_things_md(sql_q, params)
+    return export_notes(export_format, sql_q, params, path)
+
+
+@traced
+def export_notes(export_format, sql_q=None, params=(), path=None):
+    """Exports the notes from `sql_q` (default: all) to one file: jsonl, csv or npz (see `NotesStore.export_jsonl()`,
+    `export_csv()` and `export_npz()`). `path` defaults to obsNotes_<date>.<format> in the export folder,
+    - writes jsonl/csv to stdout. Returns the number of notes, False if it failed (None if stdout was closed)."""
+    store = get_store()
+    path = path or os.path.join(store.export_folder, f"obsNotes_{get_date()}.{export_format}")
+    start = time.perf_counter()
+    try:
+        if export_format == "npz":
+            count = store.export_npz(path, sql_q, params)
+        elif path == "-":
+            export = store.export_jsonl if export_format == "jsonl" else store.export_csv
+            try:
+                count = export(sys.stdout, sql_q, params)
+                sys.stdout.flush()
+            except BrokenPipeError:
+                log(2, " - output closed")  # e.g. piped into `head`
+                return None
+            return count
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                export = store.export_jsonl if export_format == "jsonl" else store.export_csv
+                count = export(f, sql_q, params)
+    except (OSError, sqlite3.Error) as error:
+        print(f"Exporting to {path} failed!")
+        log(1, f"export_notes() had an error: {error}")
+        return False
+    seconds = time.perf_counter() - start
+    print(f" Exported {count} notes to {path} in {seconds:.2f}s ({count / max(seconds, 0.001):.0f} notes/s).")
+    return count
+
+
+def load_index(name):
+    """Loads the file index `name` from the cache folder ({} if there is none), see `file_index()`"""
+    import json
+    try:
+        with open(os.path.join(cache_folder, f"index_{name}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(name, index):
+    """Saves the file index `name`, through a temporary file so a crash can't leave half an index"""
+    import json
+    index_path = os.path.join(cache_folder, f"index_{name}.json")
+    try:
+        with open(f"{index_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(f"{index_path}.tmp", index_path)
+    except OSError as error:
+        log(1, f"save_index() could not save {index_path}: {error}")
+
+
+def read_entry(file, stat, old_entry=None):
+    """Parses a long-file into its index entry (see `file_index()`) and returns (entry, note),
+    the note as the arguments of `write_any()` - or None if the file can't be read.
+    The iD and sync state of `old_entry` (see `sync_file()`) are kept."""
+    import frontmatter
+    entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'date': None}
+    if old_entry and 'id' in old_entry:
+        entry.update(id=old_entry['id'], synced=old_entry.get('synced'))
+    try:
+        note = post_to_note(frontmatter.load(file))
+    except Exception as error:  # anything from a half-written file or bad YAML
+        log(1, f"read_entry() could not read {file}: {error}")
+        return entry, None
+    book, chapter, part, date, the_time, tags, content = note
+    entry.update(book=book, chapter=chapter, part=part, date=date, time=the_time, length=len(content))
+    return entry, note
+
+
+@traced
+def file_index(pattern, name):
+    """Returns {path: metadata} for the long-files matching `pattern` (a glob), the metadata being
+    book, chapter, part, date, time and length (of the note). It is kept in the cache folder
+    (index_`name`.json) by path with the mtime and size of the file, so only new or changed
+    files are parsed - with nothing changed frontmatter is not even imported.
+    A file that can't be read gets the date None."""
+    import glob
+    old_index = load_index(name)
+    index = {}
+    for file in glob.glob(pattern):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue  # gone since the glob
+        entry = old_index.get(file)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            entry = read_entry(file, stat, entry)[0]
+        index[file] = entry
+    if index != old_index:
+        save_index(name, index)
+    return index
+
+
+@traced
+def sync_file(file, index):
+    """Upserts a long-file into the DB: the first time it is written as a new note and the iD
+    is kept in its entry in `index` (see `file_index()`), after that the note is updated.
+    Does nothing if the file is unchanged since the last sync, a file that can't be read or is
+    still empty (a note shorter than 6 characters) is not written. Returns the iD (or None)."""
+    stat = os.stat(file)
+    entry = index.get(file)
+    if entry and entry.get('synced') == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return entry['id']
+    entry, note = read_entry(file, stat, entry)
+    index[file] = entry
+    if note is None or len(note[6]) < 6:
+        return entry.get('id')
+    book, chapter, part, date, the_time, tags, content = note
+    store = get_store()
+    the_id = entry.get('id')
+    if the_id is not None and store.get(the_id) is not None:
+        store.update(the_id, only_alnu(book), only_alnu(chapter), only_alnu(part), date, the_time, tags, content)
+    else:
+        the_id = store.write(book, chapter, part, date, the_time, tags, content)
+    entry.update(id=the_id, synced=stat.st_mtime_ns)
+    return the_id
+
+
+def write_synced(files, index):
+    """Finishes the files that `watch()` already put in the DB: brings their notes up to date
+    and removes the files. Returns the files that were never synced (for `write_files()`)."""
+    not_synced = []
+    for file in files:
+        if index.get(file, {}).get('id') is None:
+            not_synced.append(file)
+            continue
+        try:
+            sync_file(file, index)
+            os.remove(file)
+            print(f"Note {index[file]['id']} updated from {file}!")
+        except (OSError, sqlite3.Error) as error:
+            print(f"Could not write {file}!")
+            log(1, f"write_synced() had an error: {error}")
+    return not_synced
 
 
+@traced
 def find_old_daily():
     """Find out if there are any older (and/or newer <- should not happen) daily files in the daily-folder,
-    if there is older files it writes them to db with write_file()"""
-    log(2, "find_old_daily()")
+    if there is older files it writes them to db with write_files() (or `write_synced()` if `watch()` has them).
+    The dates come from `file_index()`, so only new or changed daily files are read."""
     now_date = get_date()
-    the_file = "*.md"
-    path = os.path.join(daily_folder, the_file)
-    files = glob.glob(path)
-    return_path = "no-today-file"
-    for file in files: 
-        post = frontmatter.load(file)
-        metadata = post.metadata          
-        content = post.content
-        created = metadata.get('Created')
-        file_date = datetime.datetime.strftime(created, '%Y-%m-%d')
+    path = os.path.join(daily_folder, "*.md")
+    index = file_index(path, "daily")
+    by_date = {}
+    old_files = []
+    for file, entry in index.items():
+        file_date = entry['date']
+        if file_date is None:
+            continue
         if file_date < now_date:
             log(2, " - older than today")
-            if len(content) < 6:
+            if entry['length'] < 6:
                 log(2, " - empty")
                 print("Old daily is empty - Removed")
                 os.remove(file)
             else:
-                print("Written old daily")
-                write_file(file)
-                log(2, " - wrote old daily file to db.")
-        elif file_date == now_date:
-            log(2, " - found today!")
-            return_path = file
-    return return_path
+                old_files.append(file)
+        else:
+            by_date[file_date] = file
+    old_files = write_synced(old_files, index)
+    if write_files(old_files):
+        print(f"Written {len(old_files)} old daily")
+        log(2, " - wrote old daily files to db.")
+    return by_date.get(now_date, "no-today-file")
 
 
+@traced
 def run_daily():
     """Runs the daily routine - trying to find the daily file for today's date, creating it if not found."""
-    log(2, "run_daily()")
     return_path = find_old_daily()
     now_date = get_date()
     color = gen_color()
@@ -508,191 +2609,236 @@ def run_daily():
     return path
 
 
+@traced
 def open_today():
     """Open todays daily-file with specified editor."""
-    log(2, "open_today()")
     path = run_daily()
     os.system(editor + " " + path)
 
 
-def print_nice(cursor, choice):
+@traced
+def print_nice(cursor, choice, width=None):
     """Print function with two different ways to print:
      * `full` gives a full recount of all the information in given cursor
      * `short` just gives some information and chopped in length - in a table
+    The text is yielded a row at a time as the cursor gives them, so printing
+    (see `print_out()`) starts right away and nothing is kept in memory.
+    The table is as wide as the terminal (or `width`), the note column gets the extra space.
     """
-    log(2, "print_nice()")
-    data = cursor
-    result = ""
     match choice:
         case "full":
             log(2, " - full")
-            for row in data:
-                result += gen_write_data(row)
-                result += "\n---\n"
-            return result
+            for row in cursor:
+                yield gen_write_data(row) + "\n---\n"
 
         case "short":
             log(2, " - short")
+            import shutil
+            width = width or shutil.get_terminal_size((91, 24)).columns
             len_id = 5
             len_date = 10
             len_time = 8
-            len_tags = 20
-            len_note = 35
-            lines = []
-            for row in data:
-                if row[6]:
-                    tagses = row[6].split(";")
-                else:
-                    tagses = []
-                tags = ""
-                for tag in tagses:
-                    if len(tag) > 1:
-                        tag = f"#{tag}"
-                        tags += f"{tag} "
-                note = row[7]
-                note = note.replace("\n", " ")
-                note = (note[:30] + '[...]') if len(note) > 30 else note
-                tags = (tags[:15] + '[...]') if len(tags) > 15 else tags
-                the_id = row[0]
-                the_date = row[4]
-                the_time = row[5]
-                line = ""
-                line += f"| {the_id} "
-                for i in range(len_id - len(str(the_id))):
-                    line += " "
-                line += f"| {the_date} | {the_time} "
-                line += f"| {tags} "
-                for i in range(len_tags - len(tags)):
-                    line += " "
-                line += f"| {note} "
-                for i in range(len_note - len(note)):
-                    line += " "
-                line += "|\n"
-                lines.append(line)
-            devider = "+-"
-            for i in range(len_id):
-                devider += "-"
-            devider += "-+-"
-            for i in range(len_date):
-                devider += "-"
-            devider += "-+-"
-            for i in range(len_time):
-                devider += "-"
-            devider += "-+-"
-            for i in range(len_tags):
-                devider += "-"
-            devider += "-+-"
-            for i in range(len_note):
-                devider += "-"
-            devider += "-+\n"
-            result += devider
+            space = max(width - 36, 30)  # 36 = the three columns above and the borders
+            len_tags = 20 if space >= 55 else space // 3
+            len_note = space - len_tags
+            devider = "+-" + "-+-".join("-" * n for n in (len_id, len_date, len_time, len_tags, len_note)) + "-+\n"
+
+            def chop(text, length):
+                return (text[:length - 5] + '[...]') if len(text) > length else text
+
+            yield devider
+            for row in cursor:
+                tags = " ".join(f"#{tag}" for tag in (row[6] or "").split(";") if len(tag) > 1)
+                note = (note_text(row[7]) or "").replace("\n", " ")
+                yield (f"| {row[0]:<{len_id}} | {row[4]:<{len_date}} | {row[5]:<{len_time}} "
+                       f"| {chop(tags, len_tags):<{len_tags}} | {chop(note, len_note):<{len_note}} |\n"
+                       f"{devider}")
+
+
+@traced
+def print_out(lines, pager=False):
+    """Writes the lines from `print_nice()` to the terminal as they are made.
+    With `pager` (and output to a terminal) they are piped into your pager instead -
+    `pager` in config.yaml or else $PAGER (nothing set = no pager)."""
+    import subprocess
+    command = ""
+    if pager and sys.stdout.isatty():
+        command = cfg['pager'] or os.environ.get('PAGER', '')
+    try:
+        if not command:
             for line in lines:
-                result += line
-                result += devider
-            return result
+                sys.stdout.write(line)
+            sys.stdout.flush()
+            return
+        pipe = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, text=True, encoding="utf-8")
+        try:
+            for line in lines:
+                pipe.stdin.write(line)
+            pipe.stdin.close()
+        except BrokenPipeError:
+            log(2, " - pager closed")  # quit before the end, that's fine
+        pipe.wait()
+    except BrokenPipeError:
+        log(2, " - output closed")  # e.g. piped into `head`
+
+
+@traced
+def print_all(after=None, limit=None, since=None, until=None):
+    """Dumps all from DB as a table, oldest first - streamed from the cursor (through the pager).
+    With a `limit` only one page is printed (starting after the key `after`) and
+    the key to continue from is returned.
+    With `since` and/or `until` (dates) only the notes of those days, on the created_ts index."""
+    sql_q = f"SELECT * FROM '{db_table}'"
+    params = ()
+    order = ("date", "iD")
+    if since or until:
+        where, params = get_store().day_range(since, until)
+        sql_q = f"{sql_q} WHERE {where}"
+        order = ("created_ts", "iD")
+    if limit:
+        rows, first, last = get_page(sql_q, params, order, after, None, limit)
+        if rows:
+            print_out(print_nice(rows, "short"), pager=True)
+        return last
+    result = get_things(f"{sql_q} ORDER BY {', '.join(order)}", params)
+    print_out(print_nice(result, "short"), pager=True)
+
+
+@traced
+def print_on_this_day(date=None):
+    """Prints the notes written on this day in the years before"""
+    try:
+        rows = get_store().on_this_day(date)
+    except sqlite3.Error as error:
+        log(1, f"print_on_this_day() had an except (sqlite3.error): {error}")
+        rows = []
+    if not rows:
+        print("Nothing written on this day before!")
+        return
+    print_out(print_nice(rows, "short"), pager=True)
 
 
-def print_all():
-    """Dumps all from DB."""
-    log(2, "print_all()")
-    result = get_things(f"SELECT * FROM '{db_table}' ORDER BY date")
-    for row in result:
-        print(row)
+@traced
+def print_timeline(since=None, until=None):
+    """Prints the number of notes of every day from `since` through `until`
+    (default: the last 30 days) with a bar"""
+    if not since and not until:
+        since = (datetime.date.fromisoformat(get_date()) - datetime.timedelta(days=29)).isoformat()
+    try:
+        days = get_store().timeline(since, until)
+    except sqlite3.Error as error:
+        log(1, f"print_timeline() had an except (sqlite3.error): {error}")
+        days = []
+    if not days:
+        print("No notes those days!")
+        return
+    most = max(count for date, count in days)
+    for date, count in days:
+        print(f" {date} {count:>6} {'#' * max(round(count / most * 50), 1)}")
 
 
+@traced
 def print_from_id(the_id):
     """Prints a post from iD"""
-    log(2, "print_from_id()")
     result = get_things(f"SELECT * FROM '{db_table}' WHERE iD={the_id}")
-    print(print_nice(result, "full"))
+    print_out(print_nice(result, "full"))
 
 
+@traced
 def get_books():
-    """Gets a list of all the books in db"""
-    log(2, "get_books()")
-    books = []
-    result = get_things(f"SELECT book FROM '{db_table}'")
-    for row in result:
-        row = only_alnu(row)
-        if row not in books:
-            books.append(row)
-    return books
+    """Gets a list of all the books in db as (book, number of notes)"""
+    return get_store().books()
 
 
+@traced
 def get_chapters(book):
-    """Gets all the chapters in given book"""
-    log(2, "get_chapters()")
-    chapters = []
-    result = get_things(f"SELECT chapter FROM '{db_table}' WHERE book = '{book}'")
-    for row in result:
-        row = only_alnu(row)
-        if row not in chapters:
-            chapters.append(row)
-    return chapters
+    """Gets all the chapters in given book as (chapter, number of notes)"""
+    return get_store().chapters(book)
 
 
+@traced
 def get_parts(book, chapter):
-    """Gets all the parts of the given chapter in the given book"""
-    log(2, "get_parts()")
-    parts = []
-    result = get_things(f"SELECT part FROM '{db_table}' WHERE book = '{book}' AND chapter = '{chapter}'")
-    for row in result:
-        row = only_alnu(row)
-        if row not in parts:
-            parts.append(row)
-    return parts
-
-
-def get_notes(book, chapter, part):
-    """Gets the notes in the given part of the given chapter in the given book"""
-    log(2, "get_notes()")
-    sql_q = (f"""SELECT *
-            FROM '{db_table}' 
-            WHERE book = '{book}' 
-            AND chapter = '{chapter}' 
-            AND part='{part}'""")
-    result = get_things(sql_q)
-    notes = print_nice(result, "short")
-    return notes
+    """Gets all the parts of the given chapter in the given book as (part, number of notes)"""
+    return get_store().parts(book, chapter)
+
 
+@traced
+def get_notes(book, chapter, part, after=None, before=None, limit=None):
+    """Gets a page (see `get_page()`) of the notes in the given part of the given chapter
+    in the given book, oldest first"""
+    return get_store().notes(book, chapter, part, after, before, limit)
 
+
+@traced
 def get_latest_db():
     """Gets the latest note in DB by iD"""
-    log(2, "get_latest_db()")
     sql_q = get_things(f"""SELECT *
         FROM '{db_table}' 
         ORDER BY ID DESC LIMIT 1""")
-    result = print_nice(sql_q, "full")
+    result = "".join(print_nice(sql_q, "full"))
     return result
 
 
 
-def search_for(choice, srch_str):
-    log(2, "search_for()")
+def tag_query(tag_str):
+    """Turns a tag expression into a query for the iD's of the matching notes
+    (see `NotesStore.tag_query()`). Returns (sql_q, params)."""
+    return get_store().tag_query(tag_str)
+
+
+@traced
+def find_tags(tag_str):
+    """Gets the notes matching a tag expression (see `tag_query()`) and returns the cursor"""
+    return get_store().find_tags(tag_str)
+
+
+def fts_query(srch_str):
+    """Turns a search string into a FTS5 query:
+     * `"some words"` is searched for as a phrase
+     * `word*` matches everything starting with word
+     * all other words have to be in the note (in any order)
+    Everything is quoted so that FTS5 operators in the input can't break the query."""
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', srch_str):
+        if phrase.strip():
+            terms.append('"' + phrase.replace('"', '""') + '"')
+        elif word:
+            prefix = "*" if word.endswith("*") else ""
+            word = word.rstrip("*").replace('"', '""')
+            if word:
+                terms.append(f'"{word}"{prefix}')
+    return " ".join(terms)
+
+
+@traced
+def search_for(choice, srch_str, after=None, before=None, limit=None):
+    """Searches the notes and returns one page of hits (see `get_page()`):
+     * `all` searches the full-text index, best match first (see `NotesStore.search()`)
+     * `tags` finds notes by a tag expression, oldest first (see `NotesStore.search_tags()`)"""
     match choice:
         case "all":
             log(2, " - all")
-            result = get_things(f"SELECT * FROM '{db_table}' WHERE tags LIKE '%{srch_str}%' or note LIKE '%{srch_str}%'")
+            return get_store().search(srch_str, after, before, limit)
         case "tags":
             log(2, " - tags")
-            result = get_things(f"SELECT * FROM '{db_table}' WHERE tags LIKE '%{srch_str}%'")
+            return get_store().search_tags(srch_str, after, before, limit)
         case _:
             print("Something went wrong!")
             logging.error(f" - Did'nt get a valid case match!")
-            return False
-    result = print_nice(result, "short")
-    return result
+            return [], None, None
+
 
+@traced
 def create_long(book, chapter, part):
     """Creates a new long-file for the given book/chapter/part and returns path"""
-    log(2, "create_long()")
     now_date = get_date()
     path = f"{tmp_folder}tmp_{now_date}_{book}_{chapter}_{part}.md"
     path = create_file(book, chapter, part, now_date, path)
     return path
 
 def write_alias():
-    alias_line = f"alias obsN='{sys.executable} {__file__}'"
+    # `python -m obsN` runs the cached bytecode, `python obsN.py` would compile the script on every run
+    alias_line = f"alias obsN='PYTHONPATH=\"{os.path.abspath(script_dir)}${{PYTHONPATH:+:$PYTHONPATH}}\" {sys.executable} -m obsN'"
     print(alias_line)
     print("\nThe line above is an example 'alias' line for .bashrc.")
     print("If written to your ~/.bashrc it lets you run this script with 'obsN' from anywhere.\n")
@@ -724,6 +2870,7 @@ def first_run():
         log_line = f"{get_date()} - {get_time()}: {line}\n"
         f.write(log_line)
     first_run_log("first_run()")
+    from pprint import pprint
     print("\nYour current config is: \n")
     pprint(cfg, width=1)
     ok_cfg = input("\nDoes this look alright to you? y/n > ")
@@ -732,17 +2879,6 @@ def first_run():
         print("\nCreated a config.yaml file in the same directory as the script-file.\n")
         print("Please modify this file to your liking and run this script agan!")
         sys.exit()
-    sql_q = (f'CREATE TABLE "{db_table}" (\n'
-             '	"iD"	INTEGER NOT NULL UNIQUE,\n'
-             '	"book"	TEXT NOT NULL,\n'
-             '	"chapter"	TEXT NOT NULL,\n'
-             '	"part"	TEXT,\n'
-             '	"date"	TEXT NOT NULL,\n'
-             '	"time"	TEXT NOT NULL,\n'
-             '	"tags"	TEXT,\n'
-             '	"note"	TEXT,\n'
-             '	PRIMARY KEY("iD" AUTOINCREMENT)\n'
-             '    )')
     for folder in folder_list:
         print(f"{folder}")
     create_all = input("Should I create these folders (and database file)? y/n > ")
@@ -756,11 +2892,7 @@ def first_run():
                 except OSError as error:
                     first_run_log(f"first_run() os.makedirs had an error: {error}")
         try:
-            conn = sqlite3.connect(db_file)
-            cur = conn.cursor()
-            cur.execute(sql_q)
-            conn.commit()
-            conn.close()
+            create_db()
             first_run_log(f" - Database created")
             write_log("DB created!")
             first_run_log(f" - First row written to DB")
@@ -781,21 +2913,21 @@ def first_run():
         sys.exit()
     
 
+@traced
 def run_menu():
     """Runs the menu-driven notes system - alot of looping and code (sanitize!)"""
-    log(2, "run_menu()")
 # Menu Loops
     def what_parts():
             # What book
         books = get_books()
         i = 0
         print("\n")
-        for book in books:
+        for book, count in books:
             i += 1
-            print(f"    {i}: {book}")
+            print(f"    {i}: {book} ({count})")
         val1 = int(input("\n What book? ")) - 1
         try:
-            book = books[val1]
+            book = books[val1][0]
         except IndexError as error:
             print(f"Something went sideways!")
             log(1, f"a_loop() books - {error}")
@@ -804,12 +2936,12 @@ def run_menu():
         chapters = get_chapters(book)
         i = 0
         print("\n")
-        for chapter in chapters:
+        for chapter, count in chapters:
             i += 1
-            print(f"    {i}: {chapter}")
+            print(f"    {i}: {chapter} ({count})")
         val2 = int(input("\n What chapter? ")) - 1
         try:
-            chapter = chapters[val2]
+            chapter = chapters[val2][0]
         except IndexError as error:
             print(f"Something went sideways!")
             log(1, f"a_loop() chapters - {error}")
@@ -818,18 +2950,41 @@ def run_menu():
         parts = get_parts(book, chapter)
         i = 0
         print("\n")
-        for part in parts:
+        for part, count in parts:
             i += 1
-            print(f"    {i}: {part}")
+            print(f"    {i}: {part} ({count})")
         val3 = int(input("\n What part? ")) - 1
         try:
-            part = parts[val3]
+            part = parts[val3][0]
         except IndexError as error:
             print(f"Something went sideways!")
             log(1, f"a_loop() parts - {error}")
             return
         return [book, chapter, part]
 
+    def page_loop(get_page_of, question):
+        """Shows the first page from get_page_of(after, before) and lets you go to the
+        next/previous page, returns the first answer that is not n or p"""
+        rows, first, last = get_page_of(None, None)
+        if not rows:
+            print("\nNo notes found!")
+            return ""
+        print_out(print_nice(rows, "short"))
+        while True:
+            answer = input(f"\n n: Next page\n p: Previous page\n{question}")
+            match answer:
+                case "n":
+                    page = get_page_of(last, None)
+                case "p":
+                    page = get_page_of(None, first)
+                case _:
+                    return answer
+            if page[0]:
+                rows, first, last = page
+                print_out(print_nice(rows, "short"))
+            else:
+                print("\nNo more notes that way!")
+
     def q_loop():
         log(2, f"run_menu() got q")
         print("\n Good Bye! \n")
@@ -840,15 +2995,16 @@ def run_menu():
 
     def h_loop():
         log(2, f"run_menu() got h")
-        files = glob.glob(f"{tmp_folder}*.md")
+        files = file_index(f"{tmp_folder}*.md", "tmp")
         file_list = []
         i = 0
         if files:
-            for file in files:
+            for file, entry in files.items():
                 file_name = file.replace(f"{tmp_folder}", "")
                 file_list.append(file)
                 i += 1
-                print(f"    {i}: {file_name}")
+                where = f"{entry['book']}/{entry['chapter']}/{entry['part']}" if entry['date'] else "(can't read it)"
+                print(f"    {i}: {file_name}  {where}")
             val1 = input(""" 
                 Do you want to:
                     e Edit a tmp file
@@ -876,7 +3032,8 @@ def run_menu():
                         write_all_tmp_files()
                     elif len(file_list) >= val2:
                         path = file_list[val2-1]
-                        write_file(path)
+                        if write_synced([path], files):
+                            write_file(path)
                 case _:
                     print("Something went wrong!")
                     logging.error(f"run_menu()- h: Got a choice thats not in the menu")
@@ -901,7 +3058,7 @@ def run_menu():
     def s_loop():
         log(2, f"run_menu() got s")
         srch_str = input("\nWhat do you want to seach for (str)? \n >")
-        srch_in = input("\n Search in:\n t: Tags \n a: Everything \n > ")
+        srch_in = input("\n Search in:\n t: Tags (tag AND/OR/NOT tag) \n a: Everything \n > ")
         match srch_in:
             case "t":
                 choice = "tags"
@@ -909,9 +3066,10 @@ def run_menu():
                 choice = "all"
             case _:
                 choice = "all"
-        print(search_for(choice, srch_str))
-        look_at = input("\nWant to look closer at any of them? (iD)")        
-        print_from_id(look_at) 
+        look_at = page_loop(lambda after, before: search_for(choice, srch_str, after, before),
+                            " Want to look closer at any of them? (iD) ")
+        if look_at.isdigit():
+            print_from_id(look_at) 
 
     def b_loop():
         try:
@@ -921,9 +3079,12 @@ def run_menu():
             chapter = parts[1]
             part = parts[2]
     # What note
-            print(get_notes(book, chapter, part))
             log(2, f"b_loop() edit/view")
-            val4 = int(input("\n 0: Edit a note\n What note id do you want to open?  "))
+            val4 = page_loop(lambda after, before: get_notes(book, chapter, part, after, before),
+                             " 0: Edit a note\n What note id do you want to open?  ")
+            if not val4:
+                return
+            val4 = int(val4)
             if val4 == 0:
                 log(2, f"b_loop() edit/view - edit")
                 val4 = int(input("\n What note id do you want to EDIT?  "))
@@ -1015,8 +3176,8 @@ def run_menu():
                 continue
 
 
+@traced
 def main():
-    log(2, "main()")
     try:
         run_menu()
     except OSError as error:
@@ -1025,18 +3186,44 @@ def main():
         return
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-o", help="Open Daily-file", action="store_true")
-parser.add_argument("-l", help="Write quick log-line", action="store_true")
-parser.add_argument("-m", help="Run the menu", action="store_true")
-parser.add_argument("-bu", help="Make backup to single archive in ~/", action="store_true")
-
-
-args = parser.parse_args()
-
+def get_args():
+    """Builds the command line parser and parses sys.argv (only when run as a script)"""
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", help="Open Daily-file", action="store_true")
+    parser.add_argument("-l", help="Write quick log-line, or every line of FILE (- for stdin) as a log", nargs="?", const="", metavar="FILE")
+    parser.add_argument("--stamped", help="With -l FILE: lines start with a timestamp (2024-01-31 12:00:00 or unix seconds)", action="store_true")
+    parser.add_argument("-m", help="Run the menu", action="store_true")
+    parser.add_argument("--serve", help="Run the capture server: -l (and scripts) write through it, batched", action="store_true")
+    parser.add_argument("--watch", help="Keep the DB up to date with the tmp and daily files as they are saved", action="store_true")
+    parser.add_argument("-bu", help="Make backup to single archive in ~/", action="store_true")
+    parser.add_argument("--inc", help="With -bu: only back up the notes changed since the last backup", action="store_true")
+    parser.add_argument("--compress", help="With -bu: compression of the archive (default: backup_compression in config)", choices=["gz", "bz2", "xz", "none"])
+    parser.add_argument("--db", help="With -bu: also save a snapshot of the DB file (SQLite backup API)", action="store_true")
+    parser.add_argument("--vacuum", help="With -bu --db: compact the snapshot (VACUUM INTO), with --compress-notes: the DB", action="store_true")
+    parser.add_argument("--compress-notes", help="Store the large notes already in the DB compressed (default: compress_notes in config or zlib, none unpacks them)",
+                        nargs="?", const="", metavar="zlib|lzma|none")
+    parser.add_argument("--restore", help="Load the notes of a backup tar (or a folder of exported notes) into the DB, keeping their iD's", metavar="SOURCE")
+    parser.add_argument("--replay", help="Rebuild the markdown files of the latest backup (full + incremental) in REPLAY", metavar="REPLAY")
+    parser.add_argument("-ex", help="Export all notes as markdown files to the export folder", action="store_true")
+    parser.add_argument("--workers", help="With -ex: number of threads writing files (default: export_workers in config), with --restore: processes reading them (default: one per CPU)", type=int)
+    parser.add_argument("--format", help="With -ex: md files (default), or all in one jsonl, csv or npz file", choices=["md", "jsonl", "csv", "npz"], default="md")
+    parser.add_argument("--out", help="With -ex --format: the file to write (- for stdout), default in the export folder", metavar="FILE")
+    parser.add_argument("--select", help="With -ex: only these notes - tag:EXPRESSION, book:BOOK, chapter:BOOK/CHAPTER, part:BOOK/CHAPTER/PART or id:ID")
+    parser.add_argument("-s", help="Search notes (full text) and print a page of hits", metavar="SEARCH")
+    parser.add_argument("--tags", help="Make -s search tags (tag AND/OR/NOT tag)", action="store_true")
+    parser.add_argument("-p", help="Print all notes, oldest first (a page at a time with --limit)", action="store_true")
+    parser.add_argument("--limit", help="Number of notes on a page for -s/-p", type=int)
+    parser.add_argument("--after", help="Start the page after this key (printed below the last page, as --after=KEY since it can start with -)")
+    parser.add_argument("--since", help="With -p/--timeline: from this day (2024-01-31)", metavar="DATE")
+    parser.add_argument("--until", help="With -p/--timeline: through this day (2024-01-31)", metavar="DATE")
+    parser.add_argument("--on-this-day", help="Print the notes written on this day in the years before", action="store_true")
+    parser.add_argument("--timeline", help="Print the number of notes per day (the last 30 days or --since/--until)", action="store_true")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = get_args()
     if not os.path.exists(db_file): # <--- Check for firstrun!
         print("\nDid not find your DB-file!\n")
         print(f"Looked in for it here: {db_file}\n")
@@ -1060,18 +3247,104 @@ if __name__ == "__main__":
         log(2, "args.o")
         open_today()
     elif args.l:
+        log(2, "args.l FILE")
+        start = time.perf_counter()
+        try:
+            if args.l == "-":
+                sys.stdin.reconfigure(errors="replace")
+                count = write_log_stream(sys.stdin, args.stamped)
+            else:
+                with open(args.l, encoding="utf-8", errors="replace") as f:
+                    count = write_log_stream(f, args.stamped)
+        except (OSError, sqlite3.Error) as error:
+            print("Something went sideways!")
+            log(1, f" - had an error! ({error})")
+        else:
+            print(f"{count} lines written to notes/journal/log in {time.perf_counter() - start:.1f}s")
+    elif args.l == "":
         log(2, "args.l")
         input_line = input("\nLine for log ('exit' to exit) > ")
-        do_it = write_log(input_line)
-        if do_it is False:
-            print("Line must be longer than 2 char!")
+        sent = send_to_server([input_line]) if len(input_line) > 2 else None
+        if sent:
+            print("Line written (by the server)")
         else:
-            print("Line written")
+            do_it = write_log(input_line)
+            if do_it is False:
+                print("Line must be longer than 2 char!")
+            else:
+                print("Line written")
     elif args.m:
         run_menu()
+    elif args.serve:
+        log(2, "args.serve")
+        serve()
+    elif args.watch:
+        log(2, "args.watch")
+        watch()
+    elif args.s:
+        log(2, "args.s")
+        after = str_to_key(args.after) if args.after else None
+        rows, first, last = search_for("tags" if args.tags else "all", args.s, after, None, args.limit)
+        if rows:
+            print_out(print_nice(rows, "short"), pager=True)
+            print(f"Next page: --after={key_to_str(last)}")
+        else:
+            print("No (more) notes found!")
+    elif args.p:
+        log(2, "args.p")
+        after = str_to_key(args.after) if args.after else None
+        try:
+            last = print_all(after, args.limit, args.since, args.until)
+        except ValueError as error:
+            print(error)
+            sys.exit(1)
+        if last:
+            print(f"Next page: --after={key_to_str(last)}")
+    elif args.on_this_day:
+        log(2, "args.on_this_day")
+        print_on_this_day()
+    elif args.timeline:
+        log(2, "args.timeline")
+        try:
+            print_timeline(args.since, args.until)
+        except ValueError as error:
+            print(error)
+            sys.exit(1)
+    elif args.ex:
+        log(2, "args.ex")
+        choice, colon, selection = (args.select or "all:").partition(":")
+        if not colon or choice not in ("tag", "book", "chapter", "part", "id", "all"):
+            print(f"Can't select {args.select!r}, use tag:EXPRESSION, book:BOOK, chapter:BOOK/CHAPTER, "
+                  "part:BOOK/CHAPTER/PART or id:ID!")
+            sys.exit(1)
+        if choice in ("chapter", "part"):
+            selection = ";" + selection.replace("/", ";")
+        if args.format == "md" and choice == "all":
+            export_things_md(f"SELECT * FROM '{db_table}'", (), args.workers)
+        elif export_selection(choice, selection, args.format, args.out) is False:
+            print("Nothing exported, see --select in -h!")
+    elif args.replay:
+        replay_backups(args.replay)
+    elif args.restore:
+        log(2, "args.restore")
+        restore_notes(args.restore, args.workers)
+    elif args.compress_notes is not None:
+        log(2, "args.compress_notes")
+        method = args.compress_notes or cfg['compress_notes'] or "zlib"
+        if method not in ("zlib", "lzma", "none"):
+            print(f"Can't compress with {method}, use zlib, lzma or none!")
+            sys.exit(1)
+        compress_notes("" if method == "none" else method, args.vacuum)
     elif args.bu:
-        file_path = make_backup()
-        print(f"Backup (as markdown files) saved to your home folder ({file_path}).\n To backup the DB (as is) just copy the '{db_file}' file.")
+        compression = "" if args.compress == "none" else args.compress
+        file_path = make_backup(args.inc, compression)
+        print(f"Backup (as markdown files) saved to your backup folder ({file_path}).")
+        if args.db:
+            snapshot_path = backup_db(args.vacuum)
+            if snapshot_path:
+                print(f"Snapshot of the DB saved to your backup folder ({snapshot_path}).")
+        else:
+            print(" To backup the DB (as is) too, use '-bu --db'.")
     else:
         log(2, "No args")
         main()
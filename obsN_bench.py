@@ -0,0 +1,309 @@
+"""
+    Benchmarks for obsN.py
+    Runs against a throw-away database in a temporary folder, your notes are never touched.
+
+    python obsN_bench.py            (all benchmarks)
+    python obsN_bench.py -n 2000    (number of notes to write)
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import frontmatter
+import obsN
+
+
+def use_tmp_db(folder, name, before=False):
+    """Points obsN at a new, empty database in the given folder (a new store, see `obsN.NotesStore`).
+    `before` leaves it in the rollback-journal mode databases had before the shared connection."""
+    obsN.close_conn()
+    obsN.store = obsN.NotesStore({'main_folder': folder, 'db_file': f"{name}.sqlite",
+                                  'backup_folder': os.path.join(folder, "backups")})
+    obsN.create_db()
+    if before:
+        obsN.get_conn().execute("PRAGMA journal_mode = DELETE")
+        obsN.close_conn()
+
+
+def report(name, count, seconds):
+    """Prints one result line"""
+    print(f"{name:<40} {count:>8} in {seconds:8.3f}s = {count / seconds:10.0f}/s")
+
+
+def write_connect_per_call(book, chapter, part, date, the_time, tags, note):
+    """The way write_any() worked before the shared connection:
+    a new connection (rollback journal, synchronous=FULL) for every note"""
+    conn = sqlite3.connect(obsN.store.db_file)
+    cur = conn.cursor()
+    cur.execute(f"""INSERT INTO {obsN.db_table} (book, chapter, part, date, time, tags, note)
+        VALUES (?,?,?,?,?,?,?);""", (book, chapter, part, date, the_time, tags, note))
+    obsN.write_tags(cur, cur.lastrowid, tags)
+    conn.commit()
+    conn.close()
+
+
+def bench_writes(folder, count):
+    """Writes/sec for single notes: connect-per-call vs. the shared, tuned connection"""
+    use_tmp_db(folder, "writes_before", before=True)
+    start = time.perf_counter()
+    for i in range(count):
+        write_connect_per_call("notes", "journal", "log", "2024-01-01", "12:00:00", "bench;", f"note {i}")
+    report("write, connect per call (before)", count, time.perf_counter() - start)
+
+    use_tmp_db(folder, "writes_after")
+    start = time.perf_counter()
+    for i in range(count):
+        obsN.write_any("notes", "journal", "log", "2024-01-01", "12:00:00", "bench;", f"note {i}")
+    report("write_any(), shared connection (after)", count, time.perf_counter() - start)
+
+
+def make_long_files(folder, count):
+    """Creates `count` long-files like the ones in the tmp folder, returns the paths"""
+    files = []
+    for i in range(count):
+        path = os.path.join(folder, f"tmp_{i}.md")
+        obsN.create_file("notes", "bench", "long", "2024-01-01", path)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(f"Long note number {i}\n" * 20)
+        files.append(path)
+    return files
+
+
+def bench_ingest(folder, count):
+    """Draining a folder of long-files: write_file() per file vs. write_files() in one transaction"""
+    files_folder = os.path.join(folder, "files")
+    os.makedirs(files_folder, exist_ok=True)
+    use_tmp_db(folder, "ingest_before", before=True)
+    files = make_long_files(files_folder, count)
+    start = time.perf_counter()
+    for file in files:
+        book, chapter, part, date, the_time, tags, note = obsN.post_to_note(frontmatter.load(file))
+        write_connect_per_call(book, chapter, part, date, the_time, tags, note)
+        os.remove(file)
+    report("long-files, one commit each (before)", count, time.perf_counter() - start)
+
+    use_tmp_db(folder, "ingest_after")
+    files = make_long_files(files_folder, count)
+    start = time.perf_counter()
+    obsN.write_files(files)
+    report("write_files(), one transaction (after)", count, time.perf_counter() - start)
+
+
+def bench_stream(folder, count):
+    """Log lines from a stream (-l -): write_any_log() per line vs. write_log_stream() in batches"""
+    lines = [f"1700000000 streamed line {i} with a few words #bench #t{i % 100}\n" for i in range(count * 10)]
+    use_tmp_db(folder, "stream_before")
+    start = time.perf_counter()
+    for line in lines[:count]:
+        obsN.write_any_log("notes", "journal", "log", line.split(" ", 1)[1])
+    report("write_any_log() per line (before)", count, time.perf_counter() - start)
+
+    use_tmp_db(folder, "stream_after")
+    start = time.perf_counter()
+    obsN.write_log_stream(lines, stamped=True)
+    report("write_log_stream(), batched (after)", len(lines), time.perf_counter() - start)
+
+
+def bench_async(folder, count):
+    """Log lines from many asyncio tasks at once: the blocking store on the event loop (a commit per line,
+    the loop stands still meanwhile) vs. AsyncNotesStore (database thread, group commits)"""
+    import asyncio
+
+    async def blocking():
+        for i in range(count):
+            obsN.store.write_log(f"async line {i} #bench")
+
+    async def grouped(store):
+        async with store:
+            await asyncio.gather(*(store.write_log(f"async line {i} #bench") for i in range(count)))
+
+    use_tmp_db(folder, "async_before")
+    start = time.perf_counter()
+    asyncio.run(blocking())
+    report("store.write_log() on the loop (before)", count, time.perf_counter() - start)
+
+    use_tmp_db(folder, "async_after")
+    store = obsN.AsyncNotesStore({'main_folder': folder, 'db_file': "async_after.sqlite"})
+    obsN.close_conn()
+    start = time.perf_counter()
+    asyncio.run(grouped(store))
+    report("AsyncNotesStore.write_log() (after)", count, time.perf_counter() - start)
+
+
+def backup_export_folder(folder):
+    """The way make_backup() worked before streaming: export every note to a file,
+    tar the export folder and delete the files again"""
+    obsN.export_things_md(f"SELECT * FROM '{obsN.db_table}'")
+    archive = shutil.make_archive(os.path.join(folder, "backup_before"), "tar", obsN.store.export_folder)
+    shutil.rmtree(obsN.store.export_folder)
+    os.makedirs(obsN.store.export_folder)
+    return archive
+
+
+def bench_backup(folder, count):
+    """Full backups: export folder + make_archive vs. streaming into a (compressed) tar"""
+    use_tmp_db(folder, "backup")
+    obsN.write_many([("notes", "journal", "log", "2024-01-01", "12:00:00", "bench;", f"Backup note {i}\n" * 20)
+                     for i in range(count)])
+    os.makedirs(obsN.store.backup_folder, exist_ok=True)
+    os.makedirs(obsN.store.export_folder, exist_ok=True)
+    start = time.perf_counter()
+    backup_export_folder(obsN.store.backup_folder)
+    report("backup via export folder (before)", count, time.perf_counter() - start)
+    for compression in ("", "gz", "bz2", "xz"):
+        start = time.perf_counter()
+        obsN.make_backup(compression=compression)
+        report(f"make_backup() streamed, {compression or 'tar'} (after)", count, time.perf_counter() - start)
+
+
+def export_one_by_one(sql_q):
+    """The way export_things_md() worked before the thread pool: exists-checks, makedirs
+    and a write for every row, on one thread"""
+    for row in obsN.get_things(sql_q):
+        folder_path = f"{obsN.store.export_folder}/{row[1]}/{row[2]}/{row[3]}/"
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        path = f"{folder_path}{row[4].replace(':', '-')}_{row[0]}.md"
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(obsN.gen_write_data(row))
+
+
+def bench_export(folder, count):
+    """Full markdown export: one file at a time vs. the thread pool (1, 4 and 8 workers)"""
+    use_tmp_db(folder, "export")
+    obsN.write_many([("notes", "journal", f"part{i % 50}", "2024-01-01", "12:00:00", "bench;", f"Export note {i}\n" * 20)
+                     for i in range(count)])
+    sql_q = f"SELECT * FROM '{obsN.db_table}'"
+    shutil.rmtree(obsN.store.export_folder, ignore_errors=True)
+    start = time.perf_counter()
+    export_one_by_one(sql_q)
+    report("export one by one (before)", count, time.perf_counter() - start)
+    for workers in (1, 4, 8):
+        shutil.rmtree(obsN.store.export_folder, ignore_errors=True)
+        start = time.perf_counter()
+        obsN.export_things_md(sql_q, workers=workers)
+        report(f"export_things_md(), {workers} workers (after)", count, time.perf_counter() - start)
+
+
+def script_folder(folder, name):
+    """Sets up a copy of obsN.py with its own config.yaml and database in `folder`/`name`,
+    returns the folder and the environment to run it in"""
+    startup_folder = os.path.join(folder, name)
+    os.makedirs(startup_folder, exist_ok=True)
+    shutil.copy(obsN.__file__, startup_folder)
+    with open(os.path.join(startup_folder, "config.yaml"), "w", encoding="utf-8") as f:
+        f.write("main_folder: obsN-files\n")
+    env = dict(os.environ, PYTHONPATH=startup_folder)
+    # Time it the way a normal install runs: with obsN's bytecode cached in __pycache__
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    setup = "import os, obsN\nfor folder in obsN.folder_list: os.makedirs(folder, exist_ok=True)\nobsN.create_db()"
+    subprocess.run([sys.executable, "-c", setup], cwd=startup_folder, env=env, check=True)
+    return startup_folder, env
+
+
+def bench_startup(folder, count):
+    """Startup of a quick log (-l): wall time per run of `python obsN.py -l` and `python -m obsN -l`
+    (best of `count`, at most 20 runs) and what `python -X importtime` says importing obsN costs.
+    Runs a copy of obsN.py with its own config.yaml and database in the temporary folder."""
+    startup_folder, env = script_folder(folder, "startup")
+    runs = min(count, 20)
+    commands = {
+        "python obsN.py -l": [sys.executable, os.path.join(startup_folder, "obsN.py"), "-l"],
+        "python -m obsN -l": [sys.executable, "-m", "obsN", "-l"],
+        "python -c pass (interpreter only)": [sys.executable, "-c", "pass"],
+    }
+    for name, command in commands.items():
+        best = None
+        for i in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, input=f"startup line {i} #bench\n", text=True, cwd=startup_folder,
+                           env=env, stdout=subprocess.DEVNULL, check=True)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        print(f"{name:<40} best of {runs:>3}: {best * 1000:8.1f} ms")
+    importtime = subprocess.run([sys.executable, "-X", "importtime", "-c", "import obsN"], cwd=startup_folder,
+                                env=env, capture_output=True, text=True, check=True).stderr
+    for line in importtime.splitlines():
+        if line.endswith("| obsN"):
+            print(f"{'import obsN (-X importtime, cumulative)':<40} {int(line.split('|')[1]) / 1000:21.1f} ms")
+
+
+def send_line(socket_path, line):
+    """One client of the server: connect, send a line, wait for the answer"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(f"{line}\n".encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        return sock.recv(100)
+
+
+def bench_serve(folder, count):
+    """Scripted logging, one line per client: a `python -m obsN -l` process per line without and
+    with the server running, and 8 clients at a time talking to the server straight over the socket"""
+    serve_folder, env = script_folder(folder, "serve")
+    socket_path = os.path.join(serve_folder, "obsN-files", obsN.cfg['socket_file'])
+    runs = min(count, 100)
+
+    def log_processes(name):
+        start = time.perf_counter()
+        for i in range(runs):
+            subprocess.run([sys.executable, "-m", "obsN", "-l"], input=f"scripted line {i} #bench\n", text=True,
+                           cwd=serve_folder, env=env, stdout=subprocess.DEVNULL, check=True)
+        report(name, runs, time.perf_counter() - start)
+
+    log_processes("python -m obsN -l per line (before)")
+    server = subprocess.Popen([sys.executable, "-m", "obsN", "--serve"], cwd=serve_folder, env=env,
+                              stdout=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        log_processes("python -m obsN -l per line, server (after)")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(8) as pool:
+            answers = list(pool.map(lambda i: send_line(socket_path, f"socket line {i} #bench"), range(count)))
+        report("socket client per line, 8 at a time (after)", count, time.perf_counter() - start)
+        assert all(answer == b"ok 1\n" for answer in answers)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def get_args():
+    """Builds the command line parser and parses sys.argv"""
+    parser = argparse.ArgumentParser(description="Benchmarks for obsN.py")
+    parser.add_argument("-n", help="Number of notes to write", type=int, default=1000)
+    parser.add_argument("--only", help="Run only these benchmarks", nargs="+",
+                        choices=["writes", "ingest", "stream", "async", "backup", "export", "startup", "serve"])
+    return parser.parse_args()
+
+
+def main():
+    """Runs the benchmarks in a temporary folder"""
+    args = get_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmarks = {
+            "writes": bench_writes,
+            "ingest": bench_ingest,
+            "stream": bench_stream,
+            "async": bench_async,
+            "backup": bench_backup,
+            "export": bench_export,
+            "startup": bench_startup,
+            "serve": bench_serve,
+        }
+        for name, bench in benchmarks.items():
+            if not args.only or name in args.only:
+                bench(tmp_dir, args.n)
+        obsN.close_conn()
+
+
+if __name__ == "__main__":
+    main()
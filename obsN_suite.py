@@ -0,0 +1,295 @@
+"""
+    Benchmark suite for obsN.py on a synthetic corpus
+    Generates a reproducible database (same size and seed = same notes), times the hot paths on it
+    and writes the results as JSON, so two runs (before and after a change) can be compared.
+    Runs in a temporary folder, your notes are never touched.
+
+    python obsN_suite.py -n 100k --json new.json                       (run, save the results)
+    python obsN_suite.py -n 100k --json new.json --compare old.json    (and compare with an earlier run)
+    python obsN_suite.py -n 5M --keep ~/obsN-corpus                    (keep the generated corpus for next time)
+"""
+import argparse
+import calendar
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import obsN
+
+
+def count_arg(value):
+    """Reads a number of notes like 10000, 10k or 5M"""
+    factor = {"k": 1000, "m": 1000000}.get(value[-1:].lower(), 1)
+    return int(float(value[:-1] if factor > 1 else value) * factor)
+
+
+seed = 1  # of the corpus, set from --seed by main()
+BOOKS = ["notes", "work", "projects", "reading", "health", "travel", "family", "ideas"]
+WORD_COUNT = 5000
+TAG_COUNT = 2000
+
+
+def zipf_weights(count, s=1.1):
+    """Cumulative weights where the n:th item is picked about 1/n^s as often as the first -
+    the way words, tags and folders are used in real notes"""
+    total = 0
+    cum_weights = []
+    for n in range(1, count + 1):
+        total += 1 / n ** s
+        cum_weights.append(total)
+    return cum_weights
+
+
+def make_words(rng, count):
+    """Makes `count` different pronounceable words"""
+    syllables = [c + v for c in "bdfghjklmnprstvz" for v in "aeiouy"]
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choices(syllables, k=rng.choice((1, 2, 2, 3, 3, 4)))))
+    return sorted(words)
+
+
+def make_tree(rng):
+    """Makes the book/chapter/part folders, a few big books with many chapters and parts"""
+    folders = []
+    for book in BOOKS:
+        for chapter in rng.sample(make_words(rng, 40), rng.randint(2, 15)):
+            for part in rng.sample(["log", "daily", "todo", "misc", *make_words(rng, 20)], rng.randint(1, 8)):
+                folders.append((book, chapter, part))
+    return folders
+
+
+def make_notes(count, seed):
+    """Yields `count` notes (tuples for `NotesStore.write_many()`), the same ones for the same seed:
+    folders, tags and words are zipf distributed, 0-5 tags per note, the number of words is
+    log-normal (median about 25, a long tail up to 3000) and the dates run over five years in iD order."""
+    rng = random.Random(seed)
+    words = make_words(rng, WORD_COUNT)
+    word_weights = zipf_weights(len(words))
+    tags = make_words(rng, TAG_COUNT)
+    tag_weights = zipf_weights(len(tags))
+    folders = make_tree(rng)
+    folder_weights = zipf_weights(len(folders), 0.9)
+    start = calendar.timegm((2020, 1, 1, 0, 0, 0))
+    span = 5 * 365 * 24 * 3600
+    for i in range(count):
+        book, chapter, part = rng.choices(folders, cum_weights=folder_weights)[0]
+        note_tags = set(rng.choices(tags, cum_weights=tag_weights, k=rng.choices(range(6), (30, 30, 20, 10, 6, 4))[0]))
+        length = min(int(rng.lognormvariate(3.2, 1.0)) + 1, 3000)
+        note = " ".join(rng.choices(words, cum_weights=word_weights, k=length))
+        stamp = time.gmtime(start + span * i // count + rng.randint(0, 3600))
+        yield (book, chapter, part, time.strftime("%Y-%m-%d", stamp), time.strftime("%H:%M:%S", stamp),
+               "".join(f"{tag};" for tag in note_tags), note)
+
+
+def make_corpus(db_path, count, seed):
+    """Writes the corpus to a new database at `db_path`, 50000 notes per transaction"""
+    store = obsN.NotesStore({'main_folder': os.path.dirname(db_path), 'db_file': os.path.basename(db_path)})
+    store.create()
+    start = time.perf_counter()
+    batch = []
+    for i, note in enumerate(make_notes(count, seed), 1):
+        batch.append(note)
+        if len(batch) == 50000:
+            store.write_many(batch)
+            batch = []
+            print(f"\r Generated {i} notes", end="", flush=True)
+    if batch:
+        store.write_many(batch)
+    store.close()
+    print(f"\r Generated {count} notes in {time.perf_counter() - start:.1f}s")
+
+
+def use_corpus(folder, count, seed, keep=None):
+    """Points obsN at a fresh copy of the corpus in `folder` (generated, or copied from `keep`)"""
+    name = f"corpus_{count}_{seed}.sqlite"
+    os.makedirs(os.path.join(folder, "tmp"), exist_ok=True)
+    db_path = os.path.join(folder, name)
+    if keep:
+        kept = os.path.join(os.path.expanduser(keep), name)
+        if not os.path.exists(kept):
+            os.makedirs(os.path.dirname(kept), exist_ok=True)
+            make_corpus(kept, count, seed)
+        shutil.copy(kept, db_path)
+    else:
+        make_corpus(db_path, count, seed)
+    obsN.close_conn()
+    obsN.store = obsN.NotesStore({'main_folder': folder, 'db_file': name,
+                                  'backup_folder': os.path.join(folder, "backups")})
+    obsN.tmp_folder = os.path.join(folder, "tmp") + os.sep
+    obsN.cache_folder = os.path.join(folder, "cache")
+    os.makedirs(obsN.cache_folder, exist_ok=True)
+    os.makedirs(obsN.store.backup_folder, exist_ok=True)
+
+
+def timed(results, name, count, function, *args):
+    """Runs `function(*args)`, records the time it took for `count` things and returns its result"""
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': round(seconds, 6), 'count': count, 'per_second': round(count / max(seconds, 1e-9), 1)}
+    print(f"{name:<44} {count:>8} in {seconds:9.4f}s = {count / max(seconds, 1e-9):12.0f}/s")
+    return result
+
+
+def repeat(function, args_list):
+    """Calls `function` once for every argument tuple"""
+    for args in args_list:
+        function(*args)
+
+
+def bench_write_log(results, count):
+    """Single quick logs on top of the corpus"""
+    runs = min(max(count // 100, 100), 2000)
+    timed(results, "write_log()", runs, repeat, obsN.write_log, [(f"suite line {i} #suite",) for i in range(runs)])
+
+
+def bench_tmp_files(results, count):
+    """Draining the tmp folder into the corpus"""
+    files = min(max(count // 100, 100), 5000)
+    for i in range(files):
+        path = f"{obsN.tmp_folder}tmp_{i}.md"
+        obsN.create_file("notes", "suite", "long", "2024-01-01", path)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(f"Long note number {i} for the suite\n" * 20)
+    timed(results, "write_all_tmp_files()", files, obsN.write_all_tmp_files)
+
+
+def bench_search(results, count):
+    """Full-text and tag searches: common, rare, phrase and prefix words, tag AND/OR/NOT, and a deep page"""
+    rng = random.Random(seed)
+    words = make_words(rng, WORD_COUNT)
+    tags = make_words(rng, TAG_COUNT)
+    searches = {
+        "common word": ("all", words[0]),
+        "rare word": ("all", words[-1]),
+        "two words": ("all", f"{words[1]} {words[5]}"),
+        "phrase": ("all", f'"{words[0]} {words[1]}"'),
+        "prefix": ("all", f"{words[2][:3]}*"),
+        "tag": ("tags", tags[0]),
+        "tag AND": ("tags", f"{tags[0]} {tags[1]}"),
+        "tag OR NOT": ("tags", f"{tags[2]} OR {tags[3]} NOT {tags[0]}"),
+    }
+    for name, (choice, srch_str) in searches.items():
+        timed(results, f"search_for() {name}", 20, repeat, obsN.search_for, [(choice, srch_str)] * 20)
+    after = None
+    for i in range(10):
+        rows, first, after = obsN.search_for("tags", tags[0], after)
+    timed(results, "search_for() tag, page 11", 20, repeat, obsN.search_for, [("tags", tags[0], after)] * 20)
+
+
+def bench_tree(results, count):
+    """The folder menus: books, chapters of every book, parts of every chapter"""
+    books = obsN.get_books()
+    chapters = [(book, chapter) for book, n in books for chapter, m in obsN.get_chapters(book)]
+    timed(results, "get_books()", 100, repeat, obsN.get_books, [()] * 100)
+    timed(results, "get_chapters()", len(books) * 10, repeat, obsN.get_chapters, [(book,) for book, n in books] * 10)
+    timed(results, "get_parts()", len(chapters), repeat, obsN.get_parts, chapters)
+
+
+def bench_print_nice(results, count):
+    """Rendering rows as the table (short) and as full notes"""
+    rows = min(count, 20000)
+    sql_q = f"SELECT * FROM '{obsN.db_table}' ORDER BY iD LIMIT {rows}"
+    for choice in ("short", "full"):
+        timed(results, f"print_nice() {choice}", rows, lambda: sum(map(len, obsN.print_nice(obsN.get_things(sql_q), choice, 120))))
+
+
+def bench_export(results, count):
+    """Exporting the newest notes (at most 20000) as markdown files"""
+    rows = min(count, 20000)
+    sql_q = f"SELECT * FROM '{obsN.db_table}' WHERE iD > (SELECT max(iD) FROM '{obsN.db_table}') - {rows}"
+    timed(results, "export_things_md()", rows, obsN.export_things_md, sql_q)
+
+
+def bench_backup(results, count):
+    """A full backup of the corpus (plain tar and the default compression), then an incremental one"""
+    notes = obsN.get_things(f"SELECT count(*) FROM '{obsN.db_table}'").fetchone()[0]
+    timed(results, "make_backup() tar", notes, obsN.make_backup, False, "")
+    timed(results, f"make_backup() {obsN.cfg['backup_compression'] or 'tar'}", notes, obsN.make_backup)
+    obsN.write_log("one changed note #suite")
+    timed(results, "make_backup() incremental", notes, obsN.make_backup, True)
+
+
+def compare(old, new, tolerance):
+    """Prints how every result changed since `old` and returns the names of the regressions"""
+    if old['meta']['notes'] != new['meta']['notes'] or old['meta']['seed'] != new['meta']['seed']:
+        print("The runs are on different corpora (notes/seed), the numbers don't compare well!")
+    regressions = []
+    print(f"\n{'':<44} {'old s':>10} {'new s':>10} {'change':>8}")
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['seconds']
+        change = result['seconds'] / max(before, 1e-9) - 1
+        mark = ""
+        if change > tolerance:
+            mark = " <- slower"
+            regressions.append(name)
+        print(f"{name:<44} {before:10.4f} {result['seconds']:10.4f} {change:+8.0%}{mark}")
+    return regressions
+
+
+def get_args():
+    """Builds the command line parser and parses sys.argv"""
+    parser = argparse.ArgumentParser(description="Benchmark suite for obsN.py on a synthetic corpus")
+    parser.add_argument("-n", help="Notes in the corpus, 10k to 5M (default 10k)", type=count_arg, default=10000)
+    parser.add_argument("--seed", help="Seed of the corpus (default 1)", type=int, default=1)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare with the results in this file (from --json)")
+    parser.add_argument("--tolerance", help="Slower than this (0.25 = 25%%) is a regression", type=float, default=0.25)
+    parser.add_argument("--keep", help="Keep the generated corpus in this folder and use it again next time")
+    parser.add_argument("--only", help="Run only these benchmarks", nargs="+",
+                        choices=["write_log", "tmp_files", "search", "tree", "print_nice", "export", "backup"])
+    return parser.parse_args()
+
+
+def main():
+    """Runs the benchmarks and writes/compares the results"""
+    global seed
+    args = get_args()
+    seed = args.seed
+    benchmarks = {
+        "write_log": bench_write_log,
+        "tmp_files": bench_tmp_files,
+        "search": bench_search,
+        "tree": bench_tree,
+        "print_nice": bench_print_nice,
+        "export": bench_export,
+        "backup": bench_backup,
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        use_corpus(tmp_dir, args.n, args.seed, args.keep)
+        for name, bench in benchmarks.items():
+            if not args.only or name in args.only:
+                bench(results, args.n)
+        obsN.close_conn()
+    run = {
+        'meta': {
+            'notes': args.n,
+            'seed': args.seed,
+            'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            if compare(json.load(f), run, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
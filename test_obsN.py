@@ -0,0 +1,90 @@
+"""
+    Tests for obsN.py
+
+    python -m pytest -q
+"""
+import pytest
+
+import obsN
+
+
+def test_read_message_plain_line():
+    book, chapter, part, date, the_time, tags, note = obsN.read_message("a plain line #tag")
+    assert (book, chapter, part, tags, note) == ("notes", "journal", "log", "tag;", "a plain line ")
+
+
+def test_read_message_bad_json():
+    with pytest.raises(ValueError):
+        obsN.read_message('{"note": "x"')
+    with pytest.raises(ValueError):
+        obsN.read_message('{"note": "x"} and more')
+
+
+@pytest.mark.parametrize("message", ['{"note": "x", "tags": 5}', '{"book": 5, "line": "abc"}',
+                                     '{"book": null, "line": "abc"}', '{"note": ["x"]}'])
+def test_read_message_not_a_string(message):
+    with pytest.raises(ValueError, match="must be a string"):
+        obsN.read_message(message)
+
+
+@pytest.mark.parametrize("message", ['{"note": "x", "date": "2024-13-45", "time": "zz"}',
+                                     '{"note": "x", "date": "2024-01-31", "time": "zz"}',
+                                     '{"note": "x", "date": "yesterday"}',
+                                     '{"note": "x", "time": "25:00:00"}'])
+def test_read_message_bad_date_or_time(message):
+    with pytest.raises(ValueError, match='"date" must be like'):
+        obsN.read_message(message)
+
+
+def test_read_message_whole_note():
+    note = obsN.read_message('{"book": "work", "note": "x", "tags": "a;", "date": "2024-01-31", "time": "12:00:00"}')
+    assert note == ("work", "journal", "log", "2024-01-31", "12:00:00", "a;", "x")
+    assert obsN.to_ts(note[3], note[4]) is not None
+
+
+def make_store(folder, name="notes.sqlite"):
+    """A new, empty store in `folder`"""
+    store = obsN.NotesStore({'main_folder': str(folder), 'db_file': name, 'backup_folder': str(folder)})
+    store.create()
+    return store
+
+
+def bulk_pending(store):
+    return store.query("SELECT 1 FROM sqlite_master WHERE name = 'bulk_pending'").fetchone() is not None
+
+
+def test_second_connection_during_restore(tmp_path):
+    source = make_store(tmp_path, "source.sqlite")
+    source.write_many([("notes", "journal", "log", "2024-01-31", "12:00:00", "old;", f"restored note {i}")
+                       for i in range(600)])
+    archive, count, removed = source.backup()
+    source.close()
+    store = make_store(tmp_path)
+    store.cfg['ingest_batch'] = 100  # a transaction (and a call of progress) per chunk of files read
+    others = []
+
+    def progress(restored, skipped):
+        with obsN.NotesStore(store.cfg, str(tmp_path)) as other:  # connects (and migrates) mid-restore
+            assert bulk_pending(other)
+            others.append(other.write_log(f"written during the restore {restored} #during"))
+
+    restored, skipped, failed = store.restore(archive, workers=1, progress=progress)
+    assert restored + skipped == 600 and failed == []  # skipped: iD's the other store took meanwhile
+    assert len(others) == 3 and not bulk_pending(store)
+    total = restored + len(others)
+    assert store.query("SELECT count(*) FROM obsNotes_fts WHERE obsNotes_fts MATCH 'restored OR during'").fetchone()[0] == total
+    assert len(store.search_tags("during")[0]) == 3
+    assert dict(store.books()) == {"notes": total}
+    assert store.query("INSERT INTO obsNotes_fts(obsNotes_fts, rank) VALUES ('integrity-check', 1)").fetchall() == []
+
+
+def test_cut_off_bulk_load_is_finished_on_connect(tmp_path):
+    store = make_store(tmp_path)
+    store.defer_bulk()
+    store.bulk.close()  # the process was killed: the OS lets go of the lock
+    store.bulk = None
+    with obsN.NotesStore(store.cfg, str(tmp_path)) as other:
+        assert not bulk_pending(other)
+        other.write_log("after the cut #cut")
+        assert len(other.search("cut")[0]) == 1
+        assert dict(other.books()) == {"notes": 1}